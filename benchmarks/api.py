@@ -0,0 +1,257 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+# Load test of the /notes API. Generates a synthetic dataset (users, notes and revisions of
+# configurable sizes) into a scratch database, drives the app through the Flask test client or a
+# local WSGI server, and prints the throughput and latency of each scenario as JSON, for
+# comparison between revisions. Run from the repository root with:
+#   python -m benchmarks.api [--users N] [--notes N] [--revisions N] [--requests N] [--server] ...
+# Settings from a config file given with --config (e.g. to enable SQLITE_PERFORMANCE_MODE or
+# the response cache) are applied on top of the defaults.
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from werkzeug.serving import make_server
+from tuhi_flask.app import app
+from tuhi_flask.auth import credential_cache, token_authority
+from tuhi_flask.cache import init_response_cache
+from tuhi_flask.controller import NotesEndpoint
+from tuhi_flask.database import init_engine, init_db, db_session
+from tuhi_flask.models import User
+from tuhi_flask.writer import init_writer, run_write
+
+PASSWORD = "benchmark"
+DATE_START = 1500000000
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+
+def _uuid(*parts):
+    return "-".join("{:08d}".format(part) for part in parts).rjust(36, "0")
+
+def _random_text(rng, num_words):
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+def _make_upload(rng, user_index, first_note, num_notes, num_revisions, text_size, date):
+    # Returns an upload of num_notes notes, each with num_revisions contents, all dated from date on
+    notes = []
+    note_contents = []
+    for n in range(first_note, first_note + num_notes):
+        note_id = _uuid(0, user_index, n)
+        notes.append({"note_id": note_id, "date_created": date})
+        for r in range(num_revisions):
+            note_contents.append({"note_content_id": _uuid(1, user_index, n, r),
+                                  "note": note_id,
+                                  "type": 0,
+                                  "data": _random_text(rng, text_size),
+                                  "date_created": date + r})
+    return {"notes": notes, "note_contents": note_contents}
+
+
+class _TestClientDriver(object):
+    def __init__(self):
+        self._client = app.test_client()
+
+    def request(self, method, path, headers, body=None):
+        response = self._client.open(path, method=method, headers=headers, data=body)
+        response.get_data()
+        return response.status_code
+
+
+class _ServerDriver(object):
+    # Serves the app from a local WSGI server in a background thread and talks to it over HTTP
+    def __init__(self):
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)  # No line per request
+        self._server = make_server("127.0.0.1", 0, app, threaded=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self._connection = http.client.HTTPConnection("127.0.0.1", self._server.server_port)
+
+    def request(self, method, path, headers, body=None):
+        self._connection.request(method, path, body=body, headers=headers)
+        response = self._connection.getresponse()
+        response.read()
+        if response.will_close:
+            self._connection.close()
+        return response.status
+
+    def close(self):
+        self._server.shutdown()
+
+
+def _configure(database_path, config_file):
+    if config_file is not None:
+        app.config.from_pyfile(os.path.abspath(config_file))
+    app.config["DATABASE_URL"] = "sqlite:///" + database_path
+    init_engine(app.config)
+    init_writer(app.config)
+    init_response_cache(app.config)
+    credential_cache.configure(app.config['AUTH_CACHE_SIZE'], app.config['AUTH_CACHE_TTL'])
+    token_authority.configure(app.config['SECRET_KEY'], app.config['TOKEN_LIFETIME'],
+                              app.config['TOKEN_REVOCATION_REFRESH'])
+
+def _generate(args):
+    # Fills the scratch database, returning the user_id of each user in order
+    rng = random.Random(args.seed)
+    with app.app_context():
+        init_db()
+        users = [User(username="user{}".format(u), password=PASSWORD) for u in range(args.users)]
+        db_session.add_all(users)
+        db_session.commit()
+        user_ids = [user.user_id for user in users]
+
+        for u, user_id in enumerate(user_ids):
+            for first_note in range(0, args.notes, args.upload_size):
+                upload = _make_upload(rng, u, first_note, min(args.upload_size, args.notes - first_note),
+                                      args.revisions, args.text_size, DATE_START)
+                run_write(NotesEndpoint._process_upload, user_id, upload,
+                          app.config['NOTE_CONTENT_DELTA_DEPTH'])
+        db_session.remove()
+    return user_ids
+
+def _percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    index = max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+def _measure(driver, num_requests, make_request):
+    # Sends num_requests requests built by make_request(i) -> (method, path, headers, body, items)
+    latencies = []
+    items = 0
+    errors = 0
+    start = time.perf_counter()
+    for i in range(num_requests):
+        method, path, headers, body, request_items = make_request(i)
+        request_start = time.perf_counter()
+        status = driver.request(method, path, headers, body)
+        latencies.append(time.perf_counter() - request_start)
+        items += request_items
+        if status >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {"requests": num_requests,
+            "errors": errors,
+            "seconds": elapsed,
+            "requests_per_second": num_requests / elapsed,
+            "items_per_second": items / elapsed,
+            "latency_mean_ms": 1000 * sum(latencies) / len(latencies),
+            "latency_p50_ms": 1000 * _percentile(latencies, 0.50),
+            "latency_p99_ms": 1000 * _percentile(latencies, 0.99),
+            "latency_max_ms": 1000 * latencies[-1]}
+
+def _run_scenarios(driver, args, user_ids):
+    rng = random.Random(args.seed + 1)
+    credentials = [{"Authorization": json.dumps({"username": "user{}".format(u), "password": PASSWORD})}
+                   for u in range(len(user_ids))]
+    items_per_user = args.notes * (1 + args.revisions)
+    after = DATE_START + args.revisions - 2  # Only the newest revision or two of each note
+
+    def get(query, items):
+        def make_request(i):
+            return "GET", "/notes" + query, credentials[i % len(credentials)], None, items
+        return make_request
+
+    def auth(i):
+        return "POST", "/token", credentials[i % len(credentials)], None, 0
+
+    uploaded = [0] * len(user_ids)
+    def bulk_post(i):
+        # Each request adds new notes, dated after all existing ones
+        u = i % len(user_ids)
+        upload = _make_upload(rng, u, args.notes + uploaded[u], args.upload_size, args.revisions,
+                              args.text_size, DATE_START + args.revisions + i)
+        uploaded[u] += args.upload_size
+        headers = dict(credentials[u], **{"Content-Type": "application/json"})
+        return "POST", "/notes", headers, json.dumps(upload), len(upload["notes"]) + len(upload["note_contents"])
+
+    scenarios = (
+        ("auth", auth),
+        ("full_sync", get("", items_per_user)),
+        ("after_sync", get("?after={}".format(after), args.notes * (1 + min(2, args.revisions)))),
+        ("head", get("?head=true", 2)),
+        ("bulk_post", bulk_post),
+    )
+
+    results = {}
+    for name, make_request in scenarios:
+        if args.scenarios is not None and name not in args.scenarios:
+            continue
+        _measure(driver, min(args.warmup, args.requests), make_request)
+        results[name] = _measure(driver, args.requests, make_request)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the tuhi-flask /notes API")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--notes", type=int, default=100, help="notes per user")
+    parser.add_argument("--revisions", type=int, default=5, help="note contents per note")
+    parser.add_argument("--text-size", type=int, default=50, help="words per note content")
+    parser.add_argument("--upload-size", type=int, default=20, help="notes per POST")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per scenario")
+    parser.add_argument("--scenarios", nargs="+", help="auth, full_sync, after_sync, head and/or bulk_post")
+    parser.add_argument("--server", action="store_true", help="go through a local WSGI server")
+    parser.add_argument("--config", help="config file applied on top of the defaults")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the results to, instead of stdout")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        _configure(os.path.join(directory, "benchmark.db"), args.config)
+
+        start = time.perf_counter()
+        user_ids = _generate(args)
+        generate_time = time.perf_counter() - start
+
+        driver = _ServerDriver() if args.server else _TestClientDriver()
+        try:
+            scenarios = _run_scenarios(driver, args, user_ids)
+        finally:
+            if args.server:
+                driver.close()
+
+    results = {"python": platform.python_version(),
+               "driver": "server" if args.server else "test_client",
+               "config": args.config,
+               "dataset": {"users": args.users,
+                           "notes_per_user": args.notes,
+                           "revisions_per_note": args.revisions,
+                           "words_per_revision": args.text_size,
+                           "generate_seconds": generate_time},
+               "scenarios": scenarios}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmark of the per-object overhead of ObjectProcessor.process(), excluding
+# any database access. Run from the repository root with:
+#   python -m benchmarks.processors [number of objects] [--baseline REV] [--revision REV]
+# With --baseline, the same cases are also run against the given git revision, and both results
+# are printed side by side. --revision measures the given revision instead of the working tree
+# (e.g. the commit that introduced an optimization, with its parent as the baseline). Revisions
+# are checked out into temporary git worktrees, and measured in alternating processes, NUM_ROUNDS
+# times each, so that both are equally affected by any other load on the machine.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from tuhi_flask.processors import ObjectProcessor, TopLevelProcessor, _validate_type, _validate_uuid, \
+    _validate_date
+
+NUM_OBJECTS = 100000
+NUM_REPEATS = 5
+NUM_ROUNDS = 3
+
+
+class BenchmarkProcessor(ObjectProcessor):
+    # Validates note-content-like objects like NoteContentProcessor does, minus the queries
+    _fields = "note_content_id", "note", "type", "data", "date_created"
+    _fields_reflected_on_error = "note_content_id"
+
+    def _validate_note_content_id(self, uuid):
+        _validate_uuid(uuid)
+
+    def _validate_note(self, note_id):
+        _validate_uuid(note_id)
+
+    def _validate_type(self, type_):
+        _validate_type(type_, int)
+
+    def _validate_data(self, data):
+        _validate_type(data, str)
+
+    def _validate_date_created(self, date):
+        _validate_date(date)
+
+
+def _make_targets(num_objects, valid):
+    targets = []
+    for i in range(num_objects):
+        targets.append({"note_content_id": "{:036d}".format(i),
+                        "note": "{:036d}".format(i),
+                        "type": 0,
+                        "data": "Lorem ipsum dolor sit amet",
+                        "date_created": 1500000000 if valid else 0})
+    return targets
+
+
+def _measure(processor, targets):
+    # Returns the best throughput, in objects per second, over NUM_REPEATS runs
+    best = None
+    for _ in range(NUM_REPEATS):
+        start = time.perf_counter()
+        for target in targets:
+            processor.process(target)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(targets) / best
+
+
+def run(num_objects):
+    # Returns a list of (case name, objects per second) pairs for the tuhi_flask being imported
+    cases = (
+        ("note contents (valid)", BenchmarkProcessor(), _make_targets(num_objects, True)),
+        ("note contents (invalid date)", BenchmarkProcessor(), _make_targets(num_objects, False)),
+        ("top level", TopLevelProcessor(), [{"notes": [], "note_contents": []}] * num_objects),
+    )
+    return [(name, _measure(processor, targets)) for name, processor, targets in cases]
+
+
+@contextmanager
+def _checkout(root, revision):
+    # Yields the directory of a temporary git worktree of revision, or root itself if it is None
+    if revision is None:
+        yield root
+        return
+    with tempfile.TemporaryDirectory(prefix="tuhi-flask-benchmark-") as directory:
+        worktree = os.path.join(directory, "tree")
+        subprocess.run(["git", "-C", root, "worktree", "add", "--detach", "--quiet", worktree, revision],
+                       check=True)
+        try:
+            yield worktree
+        finally:
+            subprocess.run(["git", "-C", root, "worktree", "remove", "--force", worktree], check=True)
+
+def _run_tree(tree, num_objects):
+    # Runs this script against the tuhi_flask in tree, in a separate process
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), str(num_objects), "--json"],
+                            env=dict(os.environ, PYTHONPATH=tree), stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output)
+
+
+def compare(baseline, revision, num_objects):
+    # Returns a list of (case name, baseline objects per second, objects per second) tuples,
+    # each the best of NUM_ROUNDS runs
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    names = []
+    best = {}
+    with _checkout(root, baseline) as baseline_tree, _checkout(root, revision) as tree:
+        for _ in range(NUM_ROUNDS):
+            for column, measured_tree in enumerate((baseline_tree, tree)):
+                for name, throughput in _run_tree(measured_tree, num_objects):
+                    if name not in names:
+                        names.append(name)
+                    best[name, column] = max(best.get((name, column), 0), throughput)
+    return [(name, best[name, 0], best[name, 1]) for name in names]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark of tuhi-flask's object processors")
+    parser.add_argument("num_objects", type=int, nargs="?", default=NUM_OBJECTS)
+    parser.add_argument("--baseline", metavar="REV", help="git revision to compare against")
+    parser.add_argument("--revision", metavar="REV", help="git revision to measure instead of the working tree")
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.json:
+        json.dump(run(args.num_objects), sys.stdout)
+    elif args.baseline is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with _checkout(root, args.revision) as tree:
+            results = run(args.num_objects) if args.revision is None else _run_tree(tree, args.num_objects)
+        for name, throughput in results:
+            print("{:<30} {:>12,.0f} objects/s".format(name, throughput))
+    else:
+        print("{:<30} {:>12} {:>12} {:>8}  (objects/s)".format("", args.baseline, args.revision or "current",
+                                                               "change"))
+        for name, baseline, throughput in compare(args.baseline, args.revision, args.num_objects):
+            print("{:<30} {:>12,.0f} {:>12,.0f} {:>+7.0%}".format(name, baseline, throughput,
+                                                                  throughput / baseline - 1))
+
+
+if __name__ == '__main__':
+    main()
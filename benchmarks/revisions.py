@@ -0,0 +1,127 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of note content storage size and full-history read cost, storing revisions in
+# full versus as deltas (NOTE_CONTENT_DELTA_DEPTH), on a synthetic edit-heavy dataset.
+# Run from the repository root with:
+#   python -m benchmarks.revisions [notes] [revisions per note] [lines per note]
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from sqlalchemy import func
+from tuhi_flask.app import app
+from tuhi_flask.database import init_engine, init_db, db_session
+from tuhi_flask.models import User, NoteContent
+
+NUM_NOTES = 20
+NUM_REVISIONS = 200
+NUM_LINES = 200
+DELTA_DEPTHS = (0, 10, 50)
+NUM_READS = 5
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+
+def _random_line(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))) + "\n"
+
+def _edit(rng, lines):
+    # Mimics a typical edit: a few lines changed, inserted or removed in one place
+    lines = list(lines)
+    position = rng.randrange(len(lines))
+    action = rng.random()
+    if action < 0.6:
+        lines[position] = _random_line(rng)
+    elif action < 0.9:
+        lines.insert(position, _random_line(rng))
+    elif len(lines) > 1:
+        del lines[position]
+    return lines
+
+def _make_upload(num_notes, num_revisions, num_lines):
+    rng = random.Random(0)
+    notes = []
+    note_contents = []
+    for n in range(num_notes):
+        note_id = "{:036d}".format(n)
+        notes.append({"note_id": note_id, "date_created": 1500000000})
+        lines = [_random_line(rng) for _ in range(num_lines)]
+        for r in range(num_revisions):
+            lines = _edit(rng, lines)
+            note_contents.append({"note_content_id": "{:018d}{:018d}".format(n, r),
+                                  "note": note_id,
+                                  "type": 0,
+                                  "data": "".join(lines),
+                                  "date_created": 1500000000 + r})
+    return notes, note_contents
+
+
+def _run(delta_depth, notes, note_contents, directory):
+    path = os.path.join(directory, "revisions-{}.db".format(delta_depth))
+    config = dict(app.config, DATABASE_URL="sqlite:///" + path, NOTE_CONTENT_DELTA_DEPTH=delta_depth)
+    app.config.update(config)
+    init_engine(config)
+
+    with app.app_context():
+        init_db()
+        db_session.add(User(username="benchmark", password="benchmark"))
+        db_session.commit()
+
+    client = app.test_client()
+    headers = {"Authorization": json.dumps({"username": "benchmark", "password": "benchmark"})}
+
+    # Uploaded one note at a time, so that revisions build on previously stored ones
+    start = time.perf_counter()
+    for note in notes:
+        contents = [nc for nc in note_contents if nc["note"] == note["note_id"]]
+        response = client.post("/notes", headers=headers,
+                               data=json.dumps({"notes": [note], "note_contents": contents}))
+        assert response.status_code == 200, response.get_data()
+    write_time = time.perf_counter() - start
+
+    best_read = None
+    for _ in range(NUM_READS):
+        start = time.perf_counter()
+        response = client.get("/notes", headers=headers)
+        elapsed = time.perf_counter() - start
+        best_read = elapsed if best_read is None else min(best_read, elapsed)
+    served = sorted(response.get_json()["note_contents"], key=lambda nc: nc["note_content_id"])
+    assert [nc["data"] for nc in served] == [nc["data"] for nc in note_contents], "Served data differs"
+
+    (stored_size,) = db_session.query(func.sum(func.length(NoteContent.data))).one()
+    db_session.remove()
+    return stored_size, os.path.getsize(path), write_time, best_read
+
+
+def main(num_notes=NUM_NOTES, num_revisions=NUM_REVISIONS, num_lines=NUM_LINES):
+    notes, note_contents = _make_upload(num_notes, num_revisions, num_lines)
+    print("{} notes x {} revisions of ~{} lines".format(num_notes, num_revisions, num_lines))
+    print("{:>11} {:>14} {:>12} {:>10} {:>14}".format("delta depth", "stored data", "file size", "upload",
+                                                     "full sync GET"))
+    with tempfile.TemporaryDirectory() as directory:
+        for delta_depth in DELTA_DEPTHS:
+            stored_size, file_size, write_time, read_time = _run(delta_depth, notes, note_contents, directory)
+            print("{:>11} {:>12,} B {:>10,} B {:>8.2f} s {:>12.3f} s".format(
+                delta_depth, stored_size, file_size, write_time, read_time))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
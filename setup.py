@@ -36,9 +36,23 @@ setup(
         'Programming Language :: Python :: 3'
     ],
     packages=find_packages(),
-    install_requires=['sqlalchemy>=1.0', 'flask-restful>=0.3', 'flask>=0.10'],
+    install_requires=['sqlalchemy>=1.4.33', 'flask-restful>=0.3', 'flask>=0.10', 'werkzeug>=0.15'],
+    extras_require={
+        'postgres': ['psycopg2'],
+        'msgpack': ['msgpack'],
+        'zstd': ['zstandard'],
+        'server': ['gunicorn>=20'],
+        'async': ['aiosqlite', 'asyncpg', 'uvicorn'],
+        'test': ['pytest'],
+    },
     entry_points={
         'console_scripts': ['tuhi-flask-dev = tuhi_flask.app:main',
-                            'tuhi-flask-init = tuhi_flask.manage:init'],
+                            'tuhi-flask-init = tuhi_flask.manage:init',
+                            'tuhi-flask-migrate = tuhi_flask.manage:migrate',
+                            'tuhi-flask-export = tuhi_flask.manage:export_data',
+                            'tuhi-flask-import = tuhi_flask.manage:import_data',
+                            'tuhi-flask-serve = tuhi_flask.server:main',
+                            'tuhi-flask-rebalance = tuhi_flask.sharding:main',
+                            'tuhi-flask-compact = tuhi_flask.compaction:main'],
     }
 )
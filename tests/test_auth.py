@@ -0,0 +1,88 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import pytest
+from tuhi_flask import auth
+from tuhi_flask.auth import TokenAuthority, TokenError, token_authority
+from tuhi_flask.response_codes import CODE_FORBIDDEN, CODE_TOKEN_INVALID, CODE_TOKEN_EXPIRED, CODE_TOKEN_REVOKED
+
+
+def _issue(client, auth_headers):
+    response = client.post('/token', headers=auth_headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["expires"] > time.time()
+    return data["token"]
+
+def _bearer(token):
+    return {"Authorization": "Bearer " + token}
+
+def _authentication_error(client, token):
+    response = client.get('/notes', headers=_bearer(token))
+    assert response.status_code == 401
+    return response.get_json()["authentication_errors"]
+
+
+def test_token(client, auth_headers):
+    token = _issue(client, auth_headers)
+    assert client.get('/notes', headers=_bearer(token)).get_json() == {"notes": [], "note_contents": []}
+
+
+def test_token_needs_password(client, auth_headers):
+    # A token cannot be used to obtain another
+    response = client.post('/token', headers=_bearer(_issue(client, auth_headers)))
+    assert response.status_code == 401
+    assert response.get_json() == {"authentication_errors": CODE_FORBIDDEN}
+
+
+def test_token_invalid(app, client, auth_headers):
+    token = _issue(client, auth_headers)
+    payload, signature = token.split(".")
+    tampered = payload + "." + ("A" if signature[0] != "A" else "B") + signature[1:]
+    assert _authentication_error(client, tampered) == CODE_TOKEN_INVALID
+
+    # Signed with another key, for a user of the forger's choosing
+    forged, expires = TokenAuthority("not " + app.config['SECRET_KEY']).issue(1)
+    assert _authentication_error(client, forged) == CODE_TOKEN_INVALID
+
+    assert _authentication_error(client, "garbage") == CODE_TOKEN_INVALID
+
+
+def test_token_expired(client, monkeypatch):
+    monkeypatch.setattr(token_authority, "lifetime", -1)
+    token, expires = token_authority.issue(1)
+    assert _authentication_error(client, token) == CODE_TOKEN_EXPIRED
+
+
+def test_token_revoked(app, client, auth_headers, monkeypatch):
+    token = _issue(client, auth_headers)
+    # Another process, which has loaded the revocation list before the token is revoked
+    other = TokenAuthority(app.config['SECRET_KEY'], app.config['TOKEN_LIFETIME'],
+                           app.config['TOKEN_REVOCATION_REFRESH'])
+    assert other.verify(token) == 1
+
+    assert client.delete('/token', headers=_bearer(token)).status_code == 200
+    assert _authentication_error(client, token) == CODE_TOKEN_REVOKED
+
+    # The other process only learns of it once it reloads the list
+    assert other.verify(token) == 1
+    now = time.monotonic()
+    monkeypatch.setattr(auth.time, "monotonic", lambda: now + app.config['TOKEN_REVOCATION_REFRESH'])
+    with pytest.raises(TokenError) as excinfo:
+        other.verify(token)
+    assert int(excinfo.value) == CODE_TOKEN_REVOKED
@@ -0,0 +1,74 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import pytest
+from tuhi_flask.cache import FileCacheBackend, MemoryCacheBackend, response_cache
+from test_notes import UPLOAD
+
+
+@pytest.fixture
+def cached_client(client):
+    response_cache.configure(MemoryCacheBackend(16))
+    yield client
+    response_cache.configure(None)
+
+
+def test_file_put_after_invalidate(tmp_path, monkeypatch):
+    backend = FileCacheBackend(str(tmp_path), 1024)
+    makedirs = os.makedirs
+
+    def makedirs_then_invalidate(path, *args, **kwargs):
+        # Another process invalidates the user's entries right after the directory is created
+        makedirs(path, *args, **kwargs)
+        backend.invalidate(1)
+
+    monkeypatch.setattr(os, "makedirs", makedirs_then_invalidate)
+    backend.put(1, "key", b"body")
+    monkeypatch.undo()
+
+    assert backend.get(1, "key") is None
+    backend.put(1, "key", b"body")
+    assert backend.get(1, "key") == b"body"
+
+
+def test_file_prune(tmp_path):
+    backend = FileCacheBackend(str(tmp_path), 1000)
+    backend.put(1, "old", b"x" * 400)
+    backend.put(2, "used", b"x" * 400)
+    os.utime(backend._path(1, "old"), (0, 0))
+    os.utime(backend._path(2, "used"), (1, 1))
+    backend.get(2, "used")
+
+    # The least recently used entry is deleted to make room
+    backend.put(1, "new", b"x" * 400)
+    assert backend.get(1, "old") is None
+    assert backend.get(2, "used") is not None
+    assert backend.get(1, "new") is not None
+
+
+def test_cache_key_arguments_kept_apart(cached_client, auth_headers):
+    cached_client.post('/notes', headers=auth_headers, data=json.dumps(UPLOAD))
+
+    head = cached_client.get('/notes?after=5&head=true', headers=auth_headers).get_json()
+    assert head == {"notes": UPLOAD["notes"][1:], "note_contents": UPLOAD["note_contents"][1:]}
+
+    # A single (invalid) after argument, which is ignored
+    full = cached_client.get('/notes?after=5%26head%3Dtrue', headers=auth_headers).get_json()
+    assert full == UPLOAD
+    assert response_cache.stats()["hits"] == 0
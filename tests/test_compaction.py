@@ -0,0 +1,126 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from sqlalchemy import select
+from tuhi_flask import database
+from tuhi_flask.compaction import RetentionPolicy, Compactor, SECONDS_PER_DAY
+from tuhi_flask.models import User, NoteContent, Change
+
+DAY = 1500000000 // SECONDS_PER_DAY * SECONDS_PER_DAY
+NOTE = "a" * 36
+LINES = ["line {} of a note long enough for deltas to be worth storing".format(i) for i in range(50)]
+
+
+def _revisions(*dates):
+    return [(date, "c{:035d}".format(i)) for i, date in enumerate(dates)]
+
+
+def test_no_rules():
+    assert RetentionPolicy().deletable(_revisions(1, 2, 3), 100) == set()
+
+
+def test_single_revision_kept():
+    assert RetentionPolicy(keep_revisions=0).deletable(_revisions(1), 100) == set()
+
+
+def test_keep_revisions():
+    revisions = _revisions(1, 2, 3, 4)
+    assert RetentionPolicy(keep_revisions=2).deletable(revisions, 100) == {revisions[0][1], revisions[1][1]}
+
+
+def test_keep_seconds():
+    revisions = _revisions(100, 600, 900, 950)
+    # The current revision is always kept, however old
+    assert RetentionPolicy(keep_seconds=500).deletable(revisions, 1000) == {revisions[0][1]}
+    assert RetentionPolicy(keep_seconds=10).deletable(revisions, 2000) == {revisions[0][1], revisions[1][1],
+                                                                          revisions[2][1]}
+
+
+def test_keep_daily_seconds():
+    now = DAY + 3 * SECONDS_PER_DAY
+    revisions = _revisions(DAY + 10, DAY + 20, DAY + SECONDS_PER_DAY + 5, DAY + SECONDS_PER_DAY + 50,
+                           DAY + 2 * SECONDS_PER_DAY)
+    # The latest revision of each day
+    assert RetentionPolicy(keep_daily_seconds=float('inf')).deletable(revisions, now) == {revisions[0][1],
+                                                                                         revisions[2][1]}
+    # ... of the days that ended less than keep_daily_seconds ago
+    assert RetentionPolicy(keep_daily_seconds=1.5 * SECONDS_PER_DAY).deletable(revisions, now) == \
+        {revisions[0][1], revisions[1][1], revisions[2][1]}
+
+
+def test_rules_combined():
+    revisions = _revisions(100, 200, 300, 900)
+    # Kept by either rule
+    assert RetentionPolicy(keep_revisions=2, keep_seconds=850).deletable(revisions, 1000) == {revisions[0][1]}
+
+
+def _text(revision):
+    lines = list(LINES)
+    lines[revision * 10] = "revision{} was here".format(revision)
+    return "\n".join(lines)
+
+def _stored(note_content_id):
+    note_contents = NoteContent.__table__
+    with database.engine.connect() as connection:
+        return connection.execute(select(note_contents.c.data_base_id)
+                                  .where(note_contents.c.note_content_id == note_content_id)).one_or_none()
+
+def _change_seq():
+    with database.engine.connect() as connection:
+        return connection.execute(select(User.__table__.c.change_seq)).scalar()
+
+
+def test_compact(app, client, auth_headers, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'NOTE_CONTENT_DELTA_DEPTH', 10)
+    # Two revisions on the second day, of which only the later is kept
+    dates = (DAY + 10, DAY + SECONDS_PER_DAY + 10, DAY + SECONDS_PER_DAY + 20, DAY + 2 * SECONDS_PER_DAY + 10)
+    note_contents = [{"note_content_id": "c{:035d}".format(i), "note": NOTE, "type": 0, "data": _text(i),
+                      "date_created": date} for i, date in enumerate(dates)]
+    upload = {"notes": [{"note_id": NOTE, "date_created": DAY}], "note_contents": note_contents}
+    assert client.post('/notes', headers=auth_headers, data=json.dumps(upload)).status_code == 200
+    ids = [note_content["note_content_id"] for note_content in note_contents]
+    # Each revision is stored as a delta against the previous one
+    assert [_stored(note_content_id) for note_content_id in ids] == [(None,), (ids[0],), (ids[1],), (ids[2],)]
+    etag = client.get('/notes', headers=auth_headers).headers["ETag"]
+    seq = _change_seq()
+
+    compactor = Compactor()
+    compactor.configure(RetentionPolicy(keep_daily_seconds=float('inf')), 200, 0, None,
+                        str(tmp_path / "compaction.lock"))
+    stats = compactor.compact()
+    assert (stats.notes, stats.deleted, stats.rebased) == (1, 1, 1)
+
+    # The revision based on the deleted one is re-encoded against the nearest kept one
+    assert _stored(ids[1]) is None
+    assert _stored(ids[2]) == (ids[0],)
+    with database.engine.connect() as connection:
+        assert ids[1] not in connection.execute(select(Change.__table__.c.object_id)).scalars().all()
+
+    data = client.get('/notes', headers=auth_headers).get_json()
+    assert data["note_contents"] == [note_contents[0], note_contents[2], note_contents[3]]
+
+    search = client.get('/notes/search?q=revision1', headers=auth_headers).get_json()
+    assert search["note_contents"] == []
+    search = client.get('/notes/search?q=revision2', headers=auth_headers).get_json()
+    assert search["note_contents"] == [note_contents[2]]
+
+    # Responses tagged before are renewed
+    assert _change_seq() == seq + 1
+    response = client.get('/notes', headers=dict(auth_headers, **{"If-None-Match": etag}))
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
@@ -0,0 +1,132 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import json
+from tuhi_flask.response_codes import CODE_ALREADY_EXISTS_CONFLICT, CODE_DOES_NOT_EXIST, CODE_INVALID_DATE, \
+    CODE_PASSWORD_INCORRECT
+
+NOTE_1 = "a" * 35 + "1"
+NOTE_2 = "a" * 35 + "2"
+
+UPLOAD = {"notes": [{"note_id": NOTE_1, "date_created": 1500000000},
+                    {"note_id": NOTE_2, "date_created": 1500000001}],
+          "note_contents": [{"note_content_id": "c" * 35 + "1", "note": NOTE_1, "type": 0,
+                             "data": "hello", "date_created": 1500000002},
+                            {"note_content_id": "c" * 35 + "2", "note": NOTE_2, "type": 0,
+                             "data": "world", "date_created": 1500000003}]}
+
+
+def _post(client, headers, upload):
+    return client.post('/notes', headers=headers, data=json.dumps(upload))
+
+
+def test_get_empty(client, auth_headers):
+    response = client.get('/notes', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.get_json() == {"notes": [], "note_contents": []}
+
+
+def test_get_unauthenticated(client):
+    assert client.get('/notes').status_code == 401
+
+    headers = {"Authorization": json.dumps({"username": "testuser", "password": "wrong"})}
+    response = client.get('/notes', headers=headers)
+    assert response.status_code == 401
+    assert response.get_json() == {"authentication": {"password_errors": CODE_PASSWORD_INCORRECT}}
+
+
+def test_post_then_get(client, auth_headers):
+    assert _post(client, auth_headers, UPLOAD).status_code == 200
+
+    basic = {"Authorization": "Basic " + base64.b64encode(b"testuser:password").decode("ascii")}
+    response = client.get('/notes', headers=basic)
+    assert response.status_code == 200
+    assert response.get_json() == UPLOAD
+
+
+def test_post_partial(client, auth_headers):
+    assert _post(client, auth_headers, {"notes": UPLOAD["notes"][:1], "note_contents": []}).status_code == 200
+
+    upload = {"notes": [{"note_id": NOTE_1, "date_created": 1500000000},
+                        {"note_id": NOTE_2, "date_created": 1}],
+              "note_contents": [{"note_content_id": "c" * 36, "note": "z" * 36, "type": 0,
+                                 "data": "x", "date_created": 1500000003}]}
+    response = _post(client, auth_headers, upload)
+    assert response.status_code == 202
+    data = response.get_json()
+    assert data["notes"] == [{"note_id_errors": CODE_ALREADY_EXISTS_CONFLICT, "note_id": NOTE_1},
+                             {"date_created_errors": CODE_INVALID_DATE, "note_id": NOTE_2}]
+    assert data["note_contents"] == [{"note_errors": CODE_DOES_NOT_EXIST, "note_content_id": "c" * 36}]
+
+    assert client.get('/notes', headers=auth_headers).get_json()["notes"] == UPLOAD["notes"][:1]
+
+
+def test_get_filters(client, auth_headers):
+    _post(client, auth_headers, UPLOAD)
+
+    data = client.get('/notes?head=true', headers=auth_headers).get_json()
+    assert data == {"notes": UPLOAD["notes"][1:], "note_contents": UPLOAD["note_contents"][1:]}
+
+    data = client.get('/notes?after=1500000002', headers=auth_headers).get_json()
+    assert data == {"notes": [], "note_contents": UPLOAD["note_contents"][1:]}
+
+
+def test_get_not_modified(client, auth_headers):
+    _post(client, auth_headers, UPLOAD)
+    etag = client.get('/notes', headers=auth_headers).headers["ETag"]
+
+    headers = dict(auth_headers, **{"If-None-Match": etag})
+    assert client.get('/notes', headers=headers).status_code == 304
+
+    _post(client, auth_headers, {"notes": [{"note_id": "b" * 36, "date_created": 1500000004}],
+                                 "note_contents": []})
+    assert client.get('/notes', headers=headers).status_code == 200
+
+
+def test_get_varies_on_accept(client, auth_headers):
+    _post(client, auth_headers, UPLOAD)
+    response = client.get('/notes', headers=auth_headers)
+    assert "Accept" in response.vary
+
+    # Representations are tagged apart, so that one is never taken for the other
+    columns_headers = dict(auth_headers, Accept="application/vnd.tuhi.columns+json")
+    columns_response = client.get('/notes', headers=columns_headers)
+    assert columns_response.headers["ETag"] != response.headers["ETag"]
+
+    headers = dict(columns_headers, **{"If-None-Match": response.headers["ETag"]})
+    assert client.get('/notes', headers=headers).status_code == 200
+    headers = dict(columns_headers, **{"If-None-Match": columns_response.headers["ETag"]})
+    response = client.get('/notes', headers=headers)
+    assert response.status_code == 304
+    assert "Accept" in response.vary
+
+
+def test_stream_is_json(client, auth_headers):
+    _post(client, auth_headers, UPLOAD)
+    json_etag = client.get('/notes', headers=auth_headers).headers["ETag"]
+
+    # Streams are tagged as the JSON they are written in, whatever else is preferred
+    headers = dict(auth_headers, Accept="application/msgpack, application/json;q=0.5")
+    response = client.get('/notes?stream=true', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == "application/json"
+    assert response.headers["ETag"] == json_etag
+    assert json.loads(response.get_data(as_text=True)) == UPLOAD
+
+    headers = dict(auth_headers, Accept="application/vnd.tuhi.columns+json")
+    assert client.get('/notes?stream=true', headers=headers).status_code == 406
@@ -0,0 +1,100 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+# Uploads are validated in batches (ObjectProcessor.process_batch()), which must report the same
+# errors, in the same form, as validating each object on its own with process()
+
+import json
+from tuhi_flask.database import db_session, IN_CLAUSE_CHUNK_SIZE
+from tuhi_flask.processors import NoteProcessor, NoteContentProcessor
+from tuhi_flask.response_codes import CODE_ALREADY_EXISTS_CONFLICT, CODE_DOES_NOT_EXIST, CODE_INVALID_DATE
+
+NOTE = "a" * 36
+OTHER_NOTE = "b" * 36
+
+
+def _note(note_id, date_created=1500000000):
+    return {"note_id": note_id, "date_created": date_created}
+
+def _note_content(note_content_id, note_id, data="text", date_created=1500000001):
+    return {"note_content_id": note_content_id, "note": note_id, "type": 0, "data": data,
+            "date_created": date_created}
+
+def _post(client, headers, notes, note_contents):
+    response = client.post('/notes', headers=headers, data=json.dumps({"notes": notes,
+                                                                        "note_contents": note_contents}))
+    return response.status_code, response.get_json()
+
+def _process(app, processor_class, target):
+    # The error process() reports for target on its own, against the data stored so far
+    with app.app_context():
+        passed, response = processor_class(user_id=1).process(target)
+        db_session.rollback()
+    assert not passed
+    return response
+
+
+def test_duplicates_in_upload(app, client, auth_headers):
+    notes = [_note(NOTE), _note(NOTE, 1500000005)]
+    note_contents = [_note_content("c" * 36, NOTE), _note_content("c" * 36, NOTE, "other")]
+    status, data = _post(client, auth_headers, notes, note_contents)
+    assert status == 202
+    assert data == {"notes": [{"note_id_errors": CODE_ALREADY_EXISTS_CONFLICT, "note_id": NOTE}],
+                    "note_contents": [{"note_content_id_errors": CODE_ALREADY_EXISTS_CONFLICT,
+                                       "note_content_id": "c" * 36}]}
+
+    # The later duplicates are reported as if the first ones had been uploaded before
+    assert data["notes"] == [_process(app, NoteProcessor, notes[1])]
+    assert data["note_contents"] == [_process(app, NoteContentProcessor, note_contents[1])]
+    assert client.get('/notes', headers=auth_headers).get_json() == {"notes": notes[:1],
+                                                                     "note_contents": note_contents[:1]}
+
+
+def test_note_from_same_upload(client, auth_headers):
+    notes = [_note(NOTE)]
+    note_contents = [_note_content("c" * 36, NOTE)]
+    assert _post(client, auth_headers, notes, note_contents) == (200, None)
+    assert client.get('/notes', headers=auth_headers).get_json() == {"notes": notes, "note_contents": note_contents}
+
+
+def test_note_failed_in_same_upload(app, client, auth_headers):
+    notes = [_note(NOTE), _note(OTHER_NOTE, 1)]
+    note_contents = [_note_content("c" * 36, NOTE), _note_content("d" * 36, OTHER_NOTE)]
+    status, data = _post(client, auth_headers, notes, note_contents)
+    assert status == 202
+    assert data == {"notes": [{"date_created_errors": CODE_INVALID_DATE, "note_id": OTHER_NOTE}],
+                    "note_contents": [{"note_errors": CODE_DOES_NOT_EXIST, "note_content_id": "d" * 36}]}
+    assert data["note_contents"] == [_process(app, NoteContentProcessor, note_contents[1])]
+
+
+def test_upload_over_chunk_size(client, auth_headers):
+    # Existing ids are looked up IN_CLAUSE_CHUNK_SIZE at a time
+    count = IN_CLAUSE_CHUNK_SIZE + 2
+    notes = [_note("{:036d}".format(i)) for i in range(count)]
+    note_contents = [_note_content("c{:035d}".format(i), "{:036d}".format(i)) for i in range(count)]
+    assert _post(client, auth_headers, notes, note_contents) == (200, None)
+
+    status, data = _post(client, auth_headers, notes, note_contents)
+    assert status == 202
+    assert data["notes"] == [{"note_id_errors": CODE_ALREADY_EXISTS_CONFLICT, "note_id": note["note_id"]}
+                             for note in notes]
+    assert data["note_contents"] == [{"note_content_id_errors": CODE_ALREADY_EXISTS_CONFLICT,
+                                      "note_content_id": note_content["note_content_id"]}
+                                     for note_content in note_contents]
+
+    data = client.get('/notes', headers=auth_headers).get_json()
+    assert (len(data["notes"]), len(data["note_contents"])) == (count, count)
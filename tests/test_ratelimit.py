@@ -0,0 +1,93 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import pytest
+from tuhi_flask.ratelimit import MemoryRateLimitStore, FileRateLimitStore, rate_limiter, BUDGET_AUTH_FAILURES, \
+    BUDGET_GETS, BUDGET_POST_ITEMS
+from tuhi_flask.response_codes import CODE_RATE_LIMITED
+from test_notes import UPLOAD
+
+# (burst, rate) of each budget: a token is refilled every 4 seconds
+BUDGETS = {BUDGET_AUTH_FAILURES: (2, 0.25),
+           BUDGET_GETS: (2, 0.25),
+           BUDGET_POST_ITEMS: (5, 0.25)}
+
+
+@pytest.fixture
+def limited_client(client):
+    rate_limiter.configure(MemoryRateLimitStore(100), BUDGETS)
+    yield client
+    rate_limiter.configure(None, {})
+
+
+def _assert_limited(response):
+    assert response.status_code == 429
+    assert response.get_json() == {"rate_limit_errors": CODE_RATE_LIMITED}
+    assert response.headers["Retry-After"] == "4"
+
+
+def test_gets(limited_client, auth_headers):
+    assert limited_client.get('/notes', headers=auth_headers).status_code == 200
+    assert limited_client.get('/notes/search?q=x', headers=auth_headers).status_code == 200
+    _assert_limited(limited_client.get('/notes', headers=auth_headers))
+    _assert_limited(limited_client.get('/notes/search?q=x', headers=auth_headers))
+
+
+def test_post_items(limited_client, auth_headers):
+    # Charged by the number of objects uploaded
+    assert limited_client.post('/notes', headers=auth_headers, data=json.dumps(UPLOAD)).status_code == 200
+    upload = {"notes": [{"note_id": "b" * 36, "date_created": 1500000004}],
+              "note_contents": [{"note_content_id": "d" * 36, "note": "b" * 36, "type": 0, "data": "again",
+                                 "date_created": 1500000005}]}
+    _assert_limited(limited_client.post('/notes', headers=auth_headers, data=json.dumps(upload)))
+    assert limited_client.get('/notes', headers=auth_headers).get_json() == UPLOAD
+
+
+def test_auth_failures(limited_client, auth_headers):
+    wrong = {"Authorization": json.dumps({"username": "testuser", "password": "wrong"})}
+    assert limited_client.get('/notes', headers=wrong).status_code == 401
+    assert limited_client.get('/notes', headers=wrong).status_code == 401
+
+    # Further attempts from the same address are turned away before the password is checked,
+    # even with the right one
+    _assert_limited(limited_client.get('/notes', headers=auth_headers))
+    _assert_limited(limited_client.post('/token', headers=auth_headers))
+    other_client = {"REMOTE_ADDR": "192.0.2.1"}
+    assert limited_client.get('/notes', headers=auth_headers, environ_base=other_client).status_code == 200
+
+
+def test_file_store(tmp_path):
+    store = FileRateLimitStore(str(tmp_path))
+    assert store.take("key", 2, 2, 0.5, 1000) == 0
+    assert store.take("key", 1, 2, 0.5, 1000) == 2
+    assert store.peek("key", 2, 0.5, 1001) == 0.5
+    assert store.take("key", 1, 2, 0.5, 1002) == 0
+
+
+def test_file_store_prune(tmp_path):
+    store = FileRateLimitStore(str(tmp_path))
+    # Full again at 1005
+    store.take("fast", 5, 10, 1, 1000)
+    # Full again at 2000, and belonging to a budget this process may know nothing about
+    store.take("slow", 1, 1, 0.001, 1000)
+
+    store.prune(1010)
+    assert len(os.listdir(str(tmp_path))) == 1
+    assert store.peek("fast", 10, 1, 1010) == 10
+    assert store.peek("slow", 1, 0.001, 1010) == pytest.approx(0.01)
@@ -0,0 +1,45 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import pytest
+from sqlalchemy import inspect
+from tuhi_flask import database
+from test_notes import UPLOAD
+
+
+@pytest.fixture
+def search_disabled(monkeypatch):
+    # Requested before the app fixture, so that its tables are created without the search table
+    monkeypatch.setattr(database, "search_enabled", False)
+
+
+def test_search(client, auth_headers):
+    client.post('/notes', headers=auth_headers, data=json.dumps(UPLOAD))
+
+    response = client.get('/notes/search?q=wor*', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.get_json() == {"note_contents": UPLOAD["note_contents"][1:], "offset": None}
+
+
+def test_search_disabled(search_disabled, client, auth_headers):
+    assert "note_content_search" not in inspect(database.engine).get_table_names()
+
+    response = client.post('/notes', headers=auth_headers, data=json.dumps(UPLOAD))
+    assert response.status_code == 200
+    assert client.get('/notes', headers=auth_headers).get_json() == UPLOAD
+    assert client.get('/notes/search?q=world', headers=auth_headers).status_code == 404
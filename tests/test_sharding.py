@@ -0,0 +1,116 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import pytest
+from sqlalchemy import select, func
+from sqlalchemy.engine.url import make_url
+from tuhi_flask import controller, database
+from tuhi_flask.database import Base, _create_engines
+from tuhi_flask.models import User, Note, NoteContent, Change
+from tuhi_flask.response_codes import CODE_USER_MOVED
+from tuhi_flask.sharding import DEFAULT_SHARD, move_user, use_user_shard
+from test_notes import UPLOAD
+
+SHARD = "shard1"
+
+# Uploaded after the first move, so that it only ever existed in the shard before moving back
+LATER_UPLOAD = {"notes": [{"note_id": "b" * 36, "date_created": 1500000010}],
+                "note_contents": [{"note_content_id": "d" * 36, "note": "b" * 36, "type": 0,
+                                   "data": "again", "date_created": 1500000011}]}
+
+
+@pytest.fixture
+def shard(app, tmp_path):
+    engine, write_engine = _create_engines(make_url("sqlite:///" + str(tmp_path / "shard.db")), app.config)
+    Base.metadata.create_all(bind=engine)
+    database.shard_engines[SHARD] = engine
+    yield engine
+    database.shard_engines.clear()
+    engine.dispose()
+
+
+def _user(engine):
+    users = User.__table__
+    with engine.connect() as connection:
+        return connection.execute(select(users.c.user_id, users.c.shard, users.c.change_seq)).one()
+
+def _count(engine, model):
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(model.__table__)).scalar()
+
+def _move(user_id, source, target):
+    # Small batches, so that copies and deletions take several transactions
+    move_user(user_id, source, target, grace=0, batch_size=1, log=lambda message: None)
+
+
+def _check_data(client, auth_headers, upload, seq):
+    data = client.get('/notes', headers=auth_headers).get_json()
+    assert data == upload
+
+    data = client.get('/notes?latest=true', headers=auth_headers).get_json()
+    assert data == upload
+
+    data = client.get('/notes?since_seq=0', headers=auth_headers).get_json()
+    assert data == dict(upload, seq=seq)
+
+    data = client.get('/notes/search?q=hello', headers=auth_headers).get_json()
+    assert data["note_contents"] == upload["note_contents"][:1]
+
+
+def test_move_to_shard_and_back(shard, client, auth_headers):
+    client.post('/notes', headers=auth_headers, data=json.dumps(UPLOAD))
+    user_id, _, seq = _user(database.engine)
+
+    _move(user_id, DEFAULT_SHARD, SHARD)
+    assert _user(database.engine).shard == SHARD
+    assert _user(shard) == (user_id, None, seq)
+    assert _count(database.engine, Note) == 0
+    assert _count(database.engine, NoteContent) == 0
+    assert _count(database.engine, Change) == 0
+    _check_data(client, auth_headers, UPLOAD, seq)
+
+    assert client.post('/notes', headers=auth_headers, data=json.dumps(LATER_UPLOAD)).status_code == 200
+    assert _count(shard, Note) == 3
+    assert _count(database.engine, Note) == 0
+    seq = _user(shard).change_seq
+
+    _move(user_id, SHARD, DEFAULT_SHARD)
+    assert _user(database.engine) == (user_id, None, seq)
+    assert _user(shard).shard == DEFAULT_SHARD
+    assert _count(shard, Note) == 0
+    assert _count(shard, NoteContent) == 0
+    upload = {key: UPLOAD[key] + LATER_UPLOAD[key] for key in UPLOAD}
+    _check_data(client, auth_headers, upload, seq)
+
+
+def test_upload_fenced_by_move(shard, client, auth_headers, monkeypatch):
+    users = User.__table__
+
+    def use_user_shard_then_move(user_id):
+        # The request is routed to the default database just before the user is moved away
+        use_user_shard(user_id)
+        with database.engine.begin() as connection:
+            connection.execute(users.update().where(users.c.user_id == user_id).values(shard=SHARD))
+
+    monkeypatch.setattr(controller, "use_user_shard", use_user_shard_then_move)
+    response = client.post('/notes', headers=auth_headers, data=json.dumps(UPLOAD))
+    assert response.status_code == 503
+    assert response.get_json() == {"user_errors": CODE_USER_MOVED}
+    assert "Retry-After" in response.headers
+    assert _count(database.engine, Note) == 0
+    assert _count(database.engine, Change) == 0
@@ -18,21 +18,57 @@
 import os
 from flask import Flask
 from flask_restful import Api
-from tuhi_flask.database import db_session
-from tuhi_flask.controller import NotesEndpoint
+from werkzeug.middleware.proxy_fix import ProxyFix
+from tuhi_flask.database import db_session, init_engine, current_shard
+from tuhi_flask.writer import init_writer
+from tuhi_flask.auth import credential_cache, token_authority
+from tuhi_flask.cache import init_response_cache
+from tuhi_flask.ratelimit import init_rate_limiter
+from tuhi_flask.notifications import init_change_notifier
+from tuhi_flask.compaction import compactor, init_compactor
+from tuhi_flask.controller import NotesEndpoint, TokenEndpoint, SearchEndpoint
+from tuhi_flask.encoding import representations, ResponseCompressor, RequestDecompressor
+from tuhi_flask.metrics import metrics, MetricsEndpoint
 
 app = Flask(__name__)
 app.config.from_object('tuhi_flask.default_config')
 if os.getenv('TUHI_FLASK_CONFIG') is not None:
     app.config.from_envvar('TUHI_FLASK_CONFIG')
+init_engine(app.config)
+init_writer(app.config)
+init_response_cache(app.config)
+init_rate_limiter(app.config)
+init_change_notifier(app.config)
+init_compactor(app.config)
+credential_cache.configure(app.config['AUTH_CACHE_SIZE'], app.config['AUTH_CACHE_TTL'])
+token_authority.configure(app.config['SECRET_KEY'], app.config['TOKEN_LIFETIME'],
+                          app.config['TOKEN_REVOCATION_REFRESH'])
+app.wsgi_app = RequestDecompressor(app.wsgi_app, app.config['MAX_DECOMPRESSED_REQUEST_SIZE'])
+if app.config['TRUSTED_PROXY_COUNT'] > 0:
+    # Makes request.remote_addr the client's address, as seen by the outermost trusted proxy
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_COUNT'])
+app.after_request(ResponseCompressor(app.config['COMPRESSION_MIN_SIZE'], app.config['COMPRESSION_LEVEL']))
+metrics.configure(app.config['METRICS_ENABLED'], app.config['METRICS_SERVER_TIMING'])
+if compactor.interval is not None:
+    app.before_request(compactor.ensure_started)
+if metrics.enabled:
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.finish_request)
 api = Api(app)
+for mediatype, representation in representations.items():
+    api.representation(mediatype)(representation)
 
 api.add_resource(NotesEndpoint, '/notes')
+api.add_resource(TokenEndpoint, '/token')
+api.add_resource(SearchEndpoint, '/notes/search')
+if metrics.enabled:
+    api.add_resource(MetricsEndpoint, '/metrics')
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     del exception
     db_session.remove()
+    current_shard.set(None)
 
 
 def main(debug=True):
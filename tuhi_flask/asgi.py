@@ -0,0 +1,130 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+# ASGI variant of the app, for serving many concurrent (and mostly idle) clients from an event
+# loop rather than from a thread each. Requests go through the very same WSGI app, endpoints,
+# processors and serializers, run in a greenlet by SQLAlchemy's greenlet_spawn, with database
+# access going through an async engine (aiosqlite or asyncpg, see ASYNC_DATABASE_URL). The
+# greenlet is suspended on every round trip to the database, while the password KDF and waits
+# on the group-commit writer are run in the loop's default executor (see database.run_blocking),
+# so a request holds no thread while it waits on either. Serve with an ASGI server, e.g.
+#   uvicorn tuhi_flask.asgi:application
+# or with tuhi-flask-serve --async.
+
+import io
+import sys
+from sqlalchemy.util import greenlet_spawn
+from tuhi_flask import database
+from tuhi_flask.app import app
+from tuhi_flask.database import db_session, async_scope, init_async_engine
+
+init_async_engine(app.config)
+
+
+def _make_environ(scope, body):
+    # Builds the WSGI environ of an ASGI HTTP request, per PEP 3333
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/" + scope["http_version"],
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+        elif "HTTP_" + name in environ:
+            environ["HTTP_" + name] += "," + value
+        else:
+            environ["HTTP_" + name] = value
+    # The body has been read in full, even if it was sent in chunks
+    environ["CONTENT_LENGTH"] = str(len(body))
+    environ.pop("HTTP_TRANSFER_ENCODING", None)
+    return environ
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await database.async_engine.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    elif scope["type"] != "http":
+        return
+
+    body = await _read_body(receive)
+    if body is None:
+        return
+    environ = _make_environ(scope, body)
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    # Each request is a task of its own, so this only applies to it
+    async_scope.set(object())
+    try:
+        app_iter = await greenlet_spawn(app.wsgi_app, environ, start_response)
+        try:
+            # The body is produced lazily for streamed responses, and doing so may access the database
+            chunks = iter(app_iter)
+            chunk = await greenlet_spawn(next, chunks, None)
+            status, headers = started
+            await send({"type": "http.response.start",
+                        "status": int(status.split(" ", 1)[0]),
+                        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                    for name, value in headers]})
+            if chunk is None:
+                await send({"type": "http.response.body", "body": b""})
+            while chunk is not None:
+                next_chunk = await greenlet_spawn(next, chunks, None)
+                await send({"type": "http.response.body", "body": chunk, "more_body": next_chunk is not None})
+                chunk = next_chunk
+        finally:
+            if hasattr(app_iter, "close"):
+                await greenlet_spawn(app_iter.close)
+    finally:
+        await greenlet_spawn(db_session.remove)
@@ -0,0 +1,177 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import hashlib
+import hmac
+import os
+import time
+import uuid
+from threading import Lock
+from tuhi_flask.cache import LRUCache
+from tuhi_flask.response_codes import CODE_TOKEN_INVALID, CODE_TOKEN_EXPIRED, CODE_TOKEN_REVOKED
+
+
+class CredentialCache(object):
+    # Remembers recently verified credentials so that repeat requests from the same client
+    # skip both the users-table lookup and the password KDF.
+    #
+    # Entries are keyed by username and hold the user's id, the password hash that was
+    # verified against and a keyed digest of (username, password_hash, password). Only
+    # the digest of the supplied password is kept, never the password itself, and the
+    # digest key is random per process so entries are useless outside of it. As only one
+    # password can verify against a given hash, a single entry per username suffices.
+
+    def __init__(self, max_size=1024, ttl=300):
+        self._digest_key = os.urandom(32)
+        self._entries = LRUCache(max_size, ttl)
+
+    def configure(self, max_size, ttl):
+        self._entries.configure(max_size, ttl)
+
+    def _digest(self, username, password_hash, password):
+        message = "\0".join((username, password_hash, password)).encode("utf-8")
+        return hmac.new(self._digest_key, message, hashlib.sha256).digest()
+
+    def get(self, username, password):
+        # Returns the user_id for a previously verified (username, password), or None
+        if type(username) is not str or type(password) is not str:
+            return None
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        user_id, password_hash, digest = entry
+        if hmac.compare_digest(digest, self._digest(username, password_hash, password)):
+            return user_id
+        return None
+
+    def put(self, user, password):
+        # Must only be called once password has been verified against user.password_hash
+        digest = self._digest(user.username, user.password_hash, password)
+        self._entries.put(user.username, (user.user_id, user.password_hash, digest))
+
+    def invalidate(self, username):
+        # Only affects this process; other workers will stop honouring the old password
+        # once their entry's TTL runs out.
+        self._entries.pop(username)
+
+
+credential_cache = CredentialCache()
+
+
+class TokenError(Exception):
+    def __init__(self, code):
+        self.code = code
+
+    def __int__(self):
+        return self.code
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class TokenAuthority(object):
+    # Issues and verifies signed bearer tokens of the form <payload>.<signature>, where the
+    # payload is "<user_id>:<expires>:<token_id>" and the signature is an HMAC-SHA256 of it.
+    # Verifying a token needs no database access: revoked token ids are kept in memory and
+    # reloaded from the revoked_tokens table at most once every revocation_refresh seconds.
+
+    def __init__(self, secret=None, lifetime=86400, revocation_refresh=30):
+        self._lock = Lock()
+        self._revoked = frozenset()
+        self._revoked_loaded_at = None
+        self.configure(secret, lifetime, revocation_refresh)
+
+    def configure(self, secret, lifetime, revocation_refresh):
+        if secret is None:
+            # Tokens will only be honoured by the process that issued them
+            secret = os.urandom(32)
+        elif isinstance(secret, str):
+            secret = secret.encode("utf-8")
+        self._secret = secret
+        self.lifetime = lifetime
+        self.revocation_refresh = revocation_refresh
+
+    def _sign(self, payload):
+        return hmac.new(self._secret, payload, hashlib.sha256).digest()
+
+    def issue(self, user_id):
+        # Returns a tuple of the form (token, expires)
+        expires = int(time.time()) + self.lifetime
+        payload = "{}:{}:{}".format(user_id, expires, uuid.uuid4()).encode("ascii")
+        return _b64encode(payload) + "." + _b64encode(self._sign(payload)), expires
+
+    def _parse(self, token):
+        # Returns a tuple of the form (user_id, expires, token_id) for a correctly signed token
+        try:
+            encoded_payload, encoded_signature = token.split(".")
+            payload = _b64decode(encoded_payload)
+            signature = _b64decode(encoded_signature)
+        except (ValueError, TypeError):
+            raise TokenError(CODE_TOKEN_INVALID)
+
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            raise TokenError(CODE_TOKEN_INVALID)
+
+        user_id, expires, token_id = payload.decode("ascii").split(":")
+        return int(user_id), int(expires), token_id
+
+    def verify(self, token):
+        # Returns the user_id the token was issued to, or raises a TokenError
+        user_id, expires, token_id = self._parse(token)
+        if expires <= time.time():
+            raise TokenError(CODE_TOKEN_EXPIRED)
+        if token_id in self._get_revoked():
+            raise TokenError(CODE_TOKEN_REVOKED)
+        return user_id
+
+    def revoke(self, token):
+        # Imported here as the models module itself depends on this one
+        from tuhi_flask.database import db_session
+        from tuhi_flask.models import RevokedToken
+
+        user_id, expires, token_id = self._parse(token)
+        now = int(time.time())
+        if expires <= now:
+            return
+
+        RevokedToken.query.filter(RevokedToken.expires <= now).delete(synchronize_session=False)
+        db_session.merge(RevokedToken(token_id=token_id, expires=expires))
+        db_session.commit()
+
+        with self._lock:
+            self._revoked = self._revoked | {token_id}
+
+    def _get_revoked(self):
+        now = time.monotonic()
+        loaded_at = self._revoked_loaded_at
+        if loaded_at is None or now - loaded_at >= self.revocation_refresh:
+            from tuhi_flask.database import db_session
+            from tuhi_flask.models import RevokedToken
+
+            rows = db_session.query(RevokedToken.token_id).filter(RevokedToken.expires > time.time())
+            with self._lock:
+                self._revoked = frozenset(token_id for (token_id,) in rows)
+                self._revoked_loaded_at = now
+        return self._revoked
+
+
+token_authority = TokenAuthority()
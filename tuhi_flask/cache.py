@@ -0,0 +1,246 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    # A thread-safe, size-bounded mapping whose entries expire after a fixed time-to-live.
+    # A ttl of None keeps entries until they are evicted, while a max_size or ttl of 0
+    # disables the cache entirely (every get() misses and every put() is dropped).
+
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic):
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._clock = clock
+        self.configure(max_size, ttl)
+
+    def configure(self, max_size, ttl=None):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._entries.clear()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and (self.ttl is None or self.ttl > 0)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= self._clock():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def discard_where(self, predicate):
+        # Removes every entry whose key satisfies predicate(key)
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MemoryCacheBackend(object):
+    # Keeps up to max_size response bodies in this process's memory
+
+    def __init__(self, max_size):
+        self._entries = LRUCache(max_size)
+
+    def get(self, user_id, key):
+        return self._entries.get((user_id, key))
+
+    def put(self, user_id, key, body):
+        self._entries.put((user_id, key), body)
+
+    def invalidate(self, user_id):
+        self._entries.discard_where(lambda entry_key: entry_key[0] == user_id)
+
+
+class FileCacheBackend(object):
+    # Keeps response bodies as files under directory (one subdirectory per user), so that they
+    # are shared by all worker processes on the machine. A tmpfs directory such as /dev/shm
+    # keeps them in shared memory. Once the files add up to more than max_bytes, the least
+    # recently used ones are deleted.
+
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _user_directory(self, user_id):
+        return os.path.join(self._directory, str(user_id))
+
+    def _path(self, user_id, key):
+        return os.path.join(self._user_directory(user_id), hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, user_id, key):
+        try:
+            with open(self._path(user_id, key), "rb") as f:
+                # The modification time records when the entry was last used
+                os.utime(f.fileno())
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, user_id, key, body):
+        user_directory = self._user_directory(user_id)
+        os.makedirs(user_directory, exist_ok=True)
+        # Written under a temporary name first so that readers never see a partial body
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=user_directory, prefix=".")
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(temp_path, self._path(user_id, key))
+        except FileNotFoundError:
+            # The user's entries were invalidated by another process meanwhile, taking the
+            # directory along, so this one is not stored either
+            return
+
+        # Each process sweeps the directory once it has written an eighth of max_bytes since
+        # its last sweep, so that the directory never grows far past it
+        self._written += len(body)
+        if self._written * 8 >= self._max_bytes:
+            self._written = 0
+            self.prune()
+
+    def prune(self):
+        # Deletes the least recently used entries until the rest fit in max_bytes
+        entries = []
+        total = 0
+        for user_entry in os.scandir(self._directory):
+            try:
+                for entry in os.scandir(user_entry.path):
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            except (FileNotFoundError, NotADirectoryError):
+                # Invalidated meanwhile
+                pass
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def invalidate(self, user_id):
+        shutil.rmtree(self._user_directory(user_id), ignore_errors=True)
+
+
+class ResponseCache(object):
+    # Caches serialized GET /notes responses in a pluggable backend. Callers include the user's
+    # data version in every key, so an entry can never be served once the data it was built from
+    # has changed; invalidate() merely frees the space taken by a user's outdated entries.
+
+    def __init__(self, backend=None):
+        self._lock = Lock()
+        self.configure(backend)
+
+    def configure(self, backend):
+        self._backend = backend
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.stores = 0
+            self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self._backend is not None
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, user_id, key):
+        body = self._backend.get(user_id, key)
+        self._count("misses" if body is None else "hits")
+        return body
+
+    def put(self, user_id, key, body):
+        self._backend.put(user_id, key, body)
+        self._count("stores")
+
+    def invalidate(self, user_id):
+        if self._backend is not None:
+            self._backend.invalidate(user_id)
+            self._count("invalidations")
+
+    def stats(self):
+        # Counters are kept per process
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "stores": self.stores,
+                    "invalidations": self.invalidations}
+
+
+response_cache = ResponseCache()
+
+def init_response_cache(config):
+    backend = config['RESPONSE_CACHE_BACKEND']
+    if backend is None:
+        response_cache.configure(None)
+    elif backend == 'memory':
+        response_cache.configure(MemoryCacheBackend(config['RESPONSE_CACHE_SIZE']))
+    elif backend == 'file':
+        response_cache.configure(FileCacheBackend(config['RESPONSE_CACHE_DIR'],
+                                                  config['RESPONSE_CACHE_DIR_MAX_BYTES']))
+    else:
+        raise ValueError("Unknown RESPONSE_CACHE_BACKEND: {}".format(backend))
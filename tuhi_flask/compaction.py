@@ -0,0 +1,299 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+# Revision retention. Note contents are only ever added by clients, so a note's history grows
+# without bound unless RETENTION_* policies are set, in which case the compaction job deletes the
+# revisions that none of them keeps. The current revision of each note is always kept.
+#
+# The job walks the notes of each database a batch at a time, reading the revisions' metadata and
+# then deleting, through run_write(), at most COMPACTION_BATCH_SIZE revisions per transaction,
+# so that uploads are never held up for long. Revisions kept but stored as deltas against a
+# deleted one are first re-encoded against the nearest kept revision down their chain. The change log entries of deleted revisions go
+# with them, and users' change_seq is bumped so that cached responses and ETags are renewed.
+# Clients keep the revisions they already have; syncs since any seq keep working, as sequence
+# numbers are never reused.
+#
+# The job runs every COMPACTION_INTERVAL seconds in a background thread of the app (in one
+# process at a time, coordinated through COMPACTION_LOCK_FILE), or on demand with
+# tuhi-flask-compact.
+
+import argparse
+import fcntl
+import logging
+import os
+import time
+from threading import Lock, Thread
+from sqlalchemy import and_, bindparam, func
+from tuhi_flask import database
+from tuhi_flask.database import db_session, current_shard
+from tuhi_flask.metrics import metrics
+from tuhi_flask.models import User, Note, NoteContent, Change, CHANGE_TYPE_NOTE_CONTENT
+from tuhi_flask.revisions import resolve_texts, make_delta
+from tuhi_flask.search import unindex_note_contents
+from tuhi_flask.writer import run_write
+
+SECONDS_PER_DAY = 86400
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(object):
+    # A revision is kept if any of the configured rules keeps it:
+    #   keep_revisions: it is one of the note's keep_revisions latest revisions
+    #   keep_seconds: it was created less than keep_seconds ago
+    #   keep_daily_seconds: it is the latest revision of its note created that day (UTC), and
+    #       that day is less than keep_daily_seconds ago (float('inf') to thin history forever)
+    # With no rule configured, every revision is kept.
+
+    def __init__(self, keep_revisions=None, keep_seconds=None, keep_daily_seconds=None):
+        self.keep_revisions = keep_revisions
+        self.keep_seconds = keep_seconds
+        self.keep_daily_seconds = keep_daily_seconds
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['RETENTION_KEEP_REVISIONS'], config['RETENTION_KEEP_SECONDS'],
+                   config['RETENTION_KEEP_DAILY_SECONDS'])
+
+    @property
+    def enabled(self):
+        return any(rule is not None for rule in (self.keep_revisions, self.keep_seconds, self.keep_daily_seconds))
+
+    def deletable(self, revisions, now):
+        # Takes (date_created, note_content_id) pairs of all revisions of a note and returns
+        # the set of the ids of those to delete
+        if not self.enabled or len(revisions) <= 1:
+            return set()
+        newest_first = sorted(revisions, reverse=True)
+        kept = {newest_first[0][1]}
+        if self.keep_revisions is not None:
+            kept.update(note_content_id for (date_created, note_content_id) in newest_first[:self.keep_revisions])
+        if self.keep_seconds is not None:
+            kept.update(note_content_id for (date_created, note_content_id) in newest_first
+                        if date_created >= now - self.keep_seconds)
+        if self.keep_daily_seconds is not None:
+            days = set()
+            for date_created, note_content_id in newest_first:
+                day = date_created // SECONDS_PER_DAY
+                if day not in days and (day + 1) * SECONDS_PER_DAY > now - self.keep_daily_seconds:
+                    days.add(day)
+                    kept.add(note_content_id)
+        return set(note_content_id for (date_created, note_content_id) in revisions) - kept
+
+
+class CompactionStats(object):
+    def __init__(self):
+        self.notes = 0
+        self.deleted = 0
+        self.rebased = 0
+        self.bytes_reclaimed = 0
+
+    def __str__(self):
+        return ("examined {} notes, deleted {} revisions and re-encoded {} stored against them, "
+                "reclaiming {:,} bytes".format(self.notes, self.deleted, self.rebased, self.bytes_reclaimed))
+
+
+def _rebase(new_bases):
+    # Takes a dict mapping note contents stored as deltas against revisions about to be deleted
+    # to the nearest revision down their chain that is kept (None if there is none), and stores
+    # each as a delta against the latter, or as full text. Their data_depth can only decrease,
+    # so that the depths recorded for deltas stored against them remain upper bounds.
+    # Returns the number of bytes this adds.
+    ids = set(new_bases) | set(base_id for base_id in new_bases.values() if base_id is not None)
+    stored = {}
+    depths = {}
+    for note_content_id, data, data_base_id, data_depth in db_session.query(
+            NoteContent.note_content_id, NoteContent.data, NoteContent.data_base_id, NoteContent.data_depth) \
+            .filter(NoteContent.note_content_id.in_(list(ids))):
+        stored[note_content_id] = (data, data_base_id)
+        depths[note_content_id] = data_depth
+    texts = resolve_texts(stored)
+
+    updates = []
+    added = 0
+    for note_content_id, base_id in new_bases.items():
+        data, depth = texts[note_content_id], 0
+        if base_id is not None:
+            delta = make_delta(texts[base_id], texts[note_content_id])
+            if len(delta) < len(data):
+                data, depth = delta, depths[base_id] + 1
+            else:
+                base_id = None
+        updates.append({"rebased_id": note_content_id, "rebased_data": data,
+                        "rebased_base_id": base_id, "rebased_depth": depth})
+        added += len(data) - len(stored[note_content_id][0])
+    db_session.execute(NoteContent.__table__.update()
+                       .where(NoteContent.note_content_id == bindparam("rebased_id"))
+                       .values(data=bindparam("rebased_data"), data_base_id=bindparam("rebased_base_id"),
+                               data_depth=bindparam("rebased_depth")),
+                       updates)
+    return added
+
+def _delete(revisions_by_user):
+    # Deletes the note contents given as lists of ids by user id, along with their index and
+    # change log entries. Returns the number of bytes of data this frees.
+    (size,) = db_session.query(func.coalesce(func.sum(func.length(NoteContent.data)), 0)) \
+        .filter(NoteContent.note_content_id.in_([note_content_id for ids in revisions_by_user.values()
+                                                 for note_content_id in ids])).one()
+    for user_id, ids in revisions_by_user.items():
+        unindex_note_contents(user_id, ids)
+        db_session.execute(Change.__table__.delete().where(and_(Change.user_id == user_id,
+                                                                Change.object_type == CHANGE_TYPE_NOTE_CONTENT,
+                                                                Change.object_id.in_(ids))))
+        db_session.execute(NoteContent.__table__.delete().where(NoteContent.note_content_id.in_(ids)))
+    db_session.execute(User.__table__.update()
+                       .where(and_(User.user_id.in_(list(revisions_by_user)), User.shard.is_(None)))
+                       .values(change_seq=User.change_seq + 1))
+    return size
+
+
+class Compactor(object):
+    def __init__(self):
+        self.configure(RetentionPolicy(), 200, 0, None, None)
+        self._pid = None
+        self._lock = Lock()
+
+    def configure(self, policy, batch_size, pause, interval, lock_file):
+        self.policy = policy
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.lock_file = lock_file
+
+    def _compact_notes(self, note_ids, stats, now):
+        revisions = {}
+        bases = {}
+        for note_content_id, note_id, user_id, date_created, data_base_id in db_session.query(
+                NoteContent.note_content_id, NoteContent.note_id, NoteContent.user_id, NoteContent.date_created,
+                NoteContent.data_base_id).filter(NoteContent.note_id.in_(note_ids)):
+            revisions.setdefault((user_id, note_id), []).append((date_created, note_content_id))
+            bases[note_content_id] = data_base_id
+        # Reading is done, so that the job holds no transaction open while it pauses
+        db_session.rollback()
+
+        deletable = []
+        for (user_id, note_id), note_revisions in revisions.items():
+            deletable.extend((user_id, note_content_id) for note_content_id in self.policy.deletable(note_revisions, now))
+        deleted_ids = set(note_content_id for (user_id, note_content_id) in deletable)
+        new_bases = {}
+        for note_content_id, base_id in bases.items():
+            if base_id in deleted_ids and note_content_id not in deleted_ids:
+                while base_id in deleted_ids:
+                    base_id = bases[base_id]
+                new_bases[note_content_id] = base_id
+
+        rebased = list(new_bases)
+        for i in range(0, len(rebased), self.batch_size):
+            stats.bytes_reclaimed -= run_write(_rebase, {note_content_id: new_bases[note_content_id]
+                                                         for note_content_id in rebased[i:i + self.batch_size]})
+            stats.rebased += len(rebased[i:i + self.batch_size])
+        for i in range(0, len(deletable), self.batch_size):
+            revisions_by_user = {}
+            for user_id, note_content_id in deletable[i:i + self.batch_size]:
+                revisions_by_user.setdefault(user_id, []).append(note_content_id)
+            stats.bytes_reclaimed += run_write(_delete, revisions_by_user)
+            stats.deleted += len(deletable[i:i + self.batch_size])
+            time.sleep(self.pause)
+        stats.notes += len(note_ids)
+
+    def compact(self, shard=None, stats=None):
+        # Enforces the policy on the database of the given shard (None for the default one)
+        stats = stats or CompactionStats()
+        if not self.policy.enabled:
+            return stats
+        now = int(time.time())
+        token = current_shard.set(shard)
+        try:
+            last_note_id = ""
+            while True:
+                # Only users whose data is in this database, and not moved away from it
+                note_ids = [note_id for (note_id,) in db_session.query(Note.note_id)
+                            .join(User, User.user_id == Note.user_id)
+                            .filter(Note.note_id > last_note_id, User.shard.is_(None))
+                            .order_by(Note.note_id).limit(self.batch_size)]
+                if len(note_ids) == 0:
+                    break
+                self._compact_notes(note_ids, stats, now)
+                last_note_id = note_ids[-1]
+                time.sleep(self.pause)
+        finally:
+            db_session.remove()
+            current_shard.reset(token)
+        return stats
+
+    def run_once(self):
+        # Compacts every database, unless another process is already doing so. Returns the
+        # CompactionStats, or None if the job was skipped.
+        with open(self.lock_file, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            stats = CompactionStats()
+            for shard in [None] + sorted(database.shard_engines):
+                self.compact(shard, stats)
+        if metrics.enabled:
+            metrics.count("compaction_revisions_deleted_total", stats.deleted)
+            metrics.count("compaction_bytes_reclaimed_total", stats.bytes_reclaimed)
+        return stats
+
+    def ensure_started(self):
+        # Starts the background thread, again in processes forked after it started. Registered
+        # as a before_request function, so that it runs in the processes serving requests.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                Thread(target=self._run, name="tuhi-flask-compaction", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                stats = self.run_once()
+            except Exception:
+                logger.exception("Compaction failed")
+            else:
+                if stats is not None:
+                    logger.info("Compaction %s", stats)
+
+
+compactor = Compactor()
+
+def init_compactor(config):
+    compactor.configure(RetentionPolicy.from_config(config), config['COMPACTION_BATCH_SIZE'],
+                        config['COMPACTION_PAUSE'], config['COMPACTION_INTERVAL'], config['COMPACTION_LOCK_FILE'])
+
+
+def main(argv=None):
+    from tuhi_flask.app import app
+    parser = argparse.ArgumentParser(description="Deletes the revisions that the RETENTION_* policies do not keep")
+    parser.parse_args(argv)
+    if not compactor.policy.enabled:
+        print("No retention policy is configured (RETENTION_*), so every revision is kept")
+        return
+    with app.app_context():
+        stats = compactor.run_once()
+    if stats is None:
+        print("Compaction is already running in another process")
+    else:
+        print("Compaction {}".format(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,29 +15,126 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import request, json
-from flask_restful import Resource
-from tuhi_flask.models import Note, NoteContent
+import base64
+import binascii
+import time
+from urllib.parse import urlencode
+from flask import request, json, current_app as app, Response, stream_with_context
+from flask_restful import Resource, abort
+from sqlalchemy import and_, or_
+from werkzeug.http import quote_etag
+from tuhi_flask.auth import token_authority, TokenError
+from tuhi_flask.cache import response_cache
+from tuhi_flask.encoding import negotiate_representation, MEDIATYPE_JSON
+from tuhi_flask.metrics import metrics, timed
+from tuhi_flask.notifications import change_notifier
+from tuhi_flask.ratelimit import rate_limiter, retry_after, BUDGET_AUTH_FAILURES, BUDGET_GETS, \
+    BUDGET_POST_ITEMS
+from tuhi_flask.revisions import expand_rows
+from tuhi_flask.search import parse_query, search_note_contents
+from tuhi_flask.sharding import use_user_shard, UserMoved
+from tuhi_flask import database
+from tuhi_flask.database import db_session
+from tuhi_flask.models import User, Note, NoteContent, CurrentNoteContent, Change, CHANGE_TYPE_NOTE, \
+    CHANGE_TYPE_NOTE_CONTENT
 from tuhi_flask.response_codes import *  # noqa
 from tuhi_flask.serializers import NoteSerializer, NoteContentSerializer
 from tuhi_flask.processors import TopLevelProcessor, NoteProcessor, NoteContentProcessor, AuthenticationProcessor
+from tuhi_flask.writer import run_write
 
 # For list of guaranteed-supported codes, check http://www.w3.org/Protocols/HTTP/HTRESP.html
 RESPONSE_BAD_REQUEST = 400  # HTTP: Bad Requeset
 RESPONSE_PARTIAL = 202  # HTTP: Accepted
 RESPONSE_CONFLICT = 409  # HTTP: Conflict
 RESPONSE_UNAUTHORIZED = 401  # HTTP: Unauthorized
+RESPONSE_NOT_MODIFIED = 304  # HTTP: Not Modified
+RESPONSE_NOT_FOUND = 404  # HTTP: Not Found
+RESPONSE_NOT_ACCEPTABLE = 406  # HTTP: Not Acceptable
+RESPONSE_SERVICE_UNAVAILABLE = 503  # HTTP: Service Unavailable
+RESPONSE_TOO_MANY_REQUESTS = 429  # HTTP: Too Many Requests
 
 
 top_level_processor = TopLevelProcessor()
-authentication_processor = AuthenticationProcessor()
 
 note_serializer = NoteSerializer()
 note_content_serializer = NoteContentSerializer()
 
 
-class NotesEndpoint(Resource):
+def _note_content_rows(note_content_query):
+    # Selects the serialized columns followed by NoteContent.data_base_id, as expected by expand_rows()
+    return note_content_query.with_entities(*note_content_serializer.columns(NoteContent), NoteContent.data_base_id)
+
+def _serialize_note_contents(rows):
+    # Note contents stored as deltas are expanded to their full text before being serialized
+    return note_content_serializer.serialize_many(expand_rows(rows,
+                                                              NoteContentSerializer._fields.index("note_content_id"),
+                                                              NoteContentSerializer._fields.index("data")))
+
+@timed("serialize")
+def _serialize_rows(note_rows, note_content_rows):
+    # Returns a tuple of the form (notes, note_contents) of serialized rows
+    notes = list(note_serializer.serialize_many(note_rows))
+    note_contents = list(_serialize_note_contents(note_content_rows))
+    if metrics.enabled:
+        metrics.count("rows_returned_total", len(notes), type="notes")
+        metrics.count("rows_returned_total", len(note_contents), type="note_contents")
+    return notes, note_contents
+
+def _rate_limited(wait):
+    return ({"rate_limit_errors": CODE_RATE_LIMITED}, RESPONSE_TOO_MANY_REQUESTS,
+            {"Retry-After": retry_after(wait)})
+
+def _arg_is_true(args, name):
+    return name in args and args[name].lower() == "true"
+
+def _encode_cursor(positions):
+    return base64.urlsafe_b64encode(json.dumps(positions).encode("utf-8")).rstrip(b"=").decode("ascii")
+
+def _decode_cursor(cursor):
+    # Returns a dict mapping "notes" and "note_contents" to the [date_created, id] of the
+    # last row already returned from that table (or None), raising ValueError if malformed
+    try:
+        padded_cursor = cursor + "=" * (-len(cursor) % 4)
+        positions = json.loads(base64.urlsafe_b64decode(padded_cursor.encode("ascii")).decode("utf-8"))
+    except (binascii.Error, UnicodeError):
+        raise ValueError("Malformed cursor")
+    if not isinstance(positions, dict):
+        raise ValueError("Malformed cursor")
+    for key in ("notes", "note_contents"):
+        position = positions.get(key)
+        if position is not None and not (isinstance(position, list) and len(position) == 2
+                                         and type(position[0]) is int and type(position[1]) is str):
+            raise ValueError("Malformed cursor")
+    return positions
+
+def _query_page(query, date_column, id_column, position, limit):
+    # Returns a tuple of the form (rows, more, position) holding up to limit rows ordered by
+    # (date_created, id) that come after the given position, whether there are rows past
+    # them and the position to resume from
+    if position is not None:
+        date_created, id_ = position
+        query = query.filter(or_(date_column > date_created,
+                                 and_(date_column == date_created, id_column > id_)))
+    rows = query.order_by(date_column, id_column).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if len(rows) > 0:
+        position = [getattr(rows[-1], date_column.key), getattr(rows[-1], id_column.key)]
+    return rows, more, position
+
+
+class AuthenticatedEndpoint(Resource):
+    # Subclasses should set this to False if they must be given a username and password
+    _accepts_bearer_token = True
+
+    @timed("get_user")
     def _get_user(self):
+        # Clients that failed to authenticate too often are turned away before their credentials
+        # are checked, sparing the password KDF
+        wait = rate_limiter.check(BUDGET_AUTH_FAILURES, request.remote_addr)
+        if wait is not None:
+            return False, _rate_limited(wait)
+
         response = {}
         passed = False
         if "Authorization" in request.headers:
@@ -45,17 +142,27 @@ class NotesEndpoint(Resource):
             if auth_header is not None and auth_header != "":
                 if auth_header.startswith("Basic"):
                     if request.authorization is not None:
-                        passed, result = authentication_processor.process(request.authorization, fail_fast_on_missing=True)
+                        passed, result = AuthenticationProcessor().process(request.authorization, fail_fast_on_missing=True)
                         response["authentication"] = result
                     else:
                         response["authentication_errors"] = CODE_BAD_BASIC_AUTH_FORMAT
+                elif auth_header.startswith("Bearer"):
+                    if self._accepts_bearer_token:
+                        try:
+                            result = token_authority.verify(auth_header[len("Bearer"):].strip())
+                        except TokenError as te:
+                            response["authentication_errors"] = int(te)
+                        else:
+                            passed = True
+                    else:
+                        response["authentication_errors"] = CODE_FORBIDDEN
                 else:
                     try:
                         auth_dict = json.loads(auth_header)
                     except ValueError:
                         response["authentication_errors"] = CODE_BAD_JSON
                     else:
-                        passed, result = authentication_processor.process(auth_dict, fail_fast_on_missing=True)
+                        passed, result = AuthenticationProcessor().process(auth_dict, fail_fast_on_missing=True)
                         response["authentication"] = result
             else:
                 response["authentication_errors"] = CODE_MISSING
@@ -63,27 +170,192 @@ class NotesEndpoint(Resource):
             response["authentication_errors"] = CODE_MISSING
 
         if passed:
+            use_user_shard(result)
             return True, result
         else:
+            rate_limiter.charge(BUDGET_AUTH_FAILURES, request.remote_addr)
             return False, (response, RESPONSE_UNAUTHORIZED)
 
+
+class TokenEndpoint(AuthenticatedEndpoint):
+    # Tokens can only be obtained with a username and password, so that a stolen
+    # token cannot be used to extend its own lifetime
+    _accepts_bearer_token = False
+
+    def post(self):
+        auth_ok, auth_result = self._get_user()
+        if not auth_ok:
+            return auth_result
+        else:
+            user_id = auth_result
+
+        token, expires = token_authority.issue(user_id)
+        return {'token': token,
+                'expires': expires}
+
+    def delete(self):
+        auth_header = request.headers.get("Authorization", "")
+        if not auth_header.startswith("Bearer"):
+            return {"authentication_errors": CODE_MISSING}, RESPONSE_UNAUTHORIZED
+
+        try:
+            token_authority.revoke(auth_header[len("Bearer"):].strip())
+        except TokenError as te:
+            return {"authentication_errors": int(te)}, RESPONSE_UNAUTHORIZED
+
+
+class NotesEndpoint(AuthenticatedEndpoint):
+    @timed("query_objects")
     def _query_objects(self, user_id, args):
         note_query = Note.query.filter(Note.user_id == user_id)
-        note_content_query = NoteContent.query.filter(Note.user_id == user_id)
+        note_content_query = NoteContent.query.filter(NoteContent.user_id == user_id)
 
-        if "head" in args and args["head"].lower() == "true":
-            return (note_query.order_by(Note.date_created.desc()).first(),), \
-                   (note_content_query.order_by(NoteContent.date_created.desc()).first(),)
+        if _arg_is_true(args, "head"):
+            return note_query.order_by(Note.date_created.desc()).limit(1), \
+                   note_content_query.order_by(NoteContent.date_created.desc()).limit(1)
+        elif _arg_is_true(args, "latest"):
+            # Every note, each with only its current note content
+            return note_query, \
+                   NoteContent.query.join(CurrentNoteContent,
+                                          CurrentNoteContent.note_content_id == NoteContent.note_content_id) \
+                       .filter(CurrentNoteContent.user_id == user_id)
         elif "after" in args:
             try:
                 after = int(args["after"])
             except ValueError:
                 pass
             else:
-                return note_query.filter(Note.date_created > after).all(), \
-                       note_content_query.filter(NoteContent.date_created > after).all()
+                return note_query.filter(Note.date_created > after), \
+                       note_content_query.filter(NoteContent.date_created > after)
+
+        return note_query, note_content_query
+
+    def _get_change_seq(self, user_id):
+        # The user's latest change seq, which also serves as the version of all of their data
+        (seq,) = db_session.query(User.change_seq).filter(User.user_id == user_id).one()
+        return seq
+
+    @staticmethod
+    def _is_streamed(args):
+        # Whether the response is streamed, which only full (or after) histories are
+        return _arg_is_true(args, "stream") and "since_seq" not in args and not _arg_is_true(args, "head") \
+            and "limit" not in args and "cursor" not in args
+
+    def _mediatype(self, args):
+        # Media type of the response: JSON for streams, the negotiated representation otherwise
+        if self._is_streamed(args):
+            return MEDIATYPE_JSON
+        mediatype, representation = negotiate_representation()
+        return mediatype
+
+    @staticmethod
+    def _version(user_id, seq, mediatype):
+        # Tag of the user's data up to seq, in the given representation
+        return "{}-{}-{}".format(user_id, seq, mediatype)
+
+    def _is_unchanged(self, user_id, seq, args):
+        # Whether the client already has all of the user's data up to seq
+        if request.if_none_match.contains_weak(self._version(user_id, seq, self._mediatype(args))):
+            return True
+        try:
+            return "since_seq" in args and seq <= int(args["since_seq"])
+        except ValueError:
+            return False
+
+    def _wait_for_change(self, user_id, args, wait):
+        # Returns the user's change seq, once it has moved past what the client has
+        # or after wait seconds, whichever comes first
+        subscription = change_notifier.subscribe(user_id)
+        try:
+            deadline = time.monotonic() + wait
+            seq = self._get_change_seq(user_id)
+            while self._is_unchanged(user_id, seq, args):
+                # No connection (or snapshot, which would hide the change) is held while waiting
+                db_session.rollback()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not subscription.wait(remaining):
+                    break
+                seq = self._get_change_seq(user_id)
+            return seq
+        finally:
+            change_notifier.unsubscribe(subscription)
+
+    def _query_changes(self, user_id, since_seq, seq):
+        # Returns a tuple of the form (note_query, note_content_query) selecting the objects logged
+        # after since_seq, up to and including the user's latest change seq. Bounding the range
+        # by seq ensures changes still being committed are left to the next sync.
+        in_range = and_(Change.user_id == user_id, Change.seq > since_seq, Change.seq <= seq)
+
+        note_query = Note.query.join(Change, and_(Change.object_type == CHANGE_TYPE_NOTE,
+                                                  Change.object_id == Note.note_id)) \
+            .filter(in_range).order_by(Change.seq)
+        note_content_query = NoteContent.query.join(Change, and_(Change.object_type == CHANGE_TYPE_NOTE_CONTENT,
+                                                                 Change.object_id == NoteContent.note_content_id)) \
+            .filter(in_range).order_by(Change.seq)
+        return note_query, note_content_query
+
+    def _get_changes(self, user_id, args, seq):
+        try:
+            since_seq = int(args["since_seq"])
+        except ValueError:
+            return {"since_seq_errors": CODE_INCORRECT_TYPE}, RESPONSE_BAD_REQUEST
 
-        return note_query.all(), note_content_query.all()
+        note_query, note_content_query = self._query_changes(user_id, since_seq, seq)
+        note_rows = note_query.with_entities(*note_serializer.columns(Note))
+        note_content_rows = _note_content_rows(note_content_query)
+
+        notes, note_contents = _serialize_rows(note_rows, note_content_rows)
+        return {'notes': notes,
+                'note_contents': note_contents,
+                'seq': seq}
+
+    def _get_page(self, note_query, note_content_query, args):
+        try:
+            limit = int(args.get("limit", app.config['SYNC_PAGE_SIZE_MAX']))
+        except ValueError:
+            return {"limit_errors": CODE_INCORRECT_TYPE}, RESPONSE_BAD_REQUEST
+        if limit < 1:
+            return {"limit_errors": CODE_INCORRECT_TYPE}, RESPONSE_BAD_REQUEST
+        limit = min(limit, app.config['SYNC_PAGE_SIZE_MAX'])
+
+        try:
+            positions = _decode_cursor(args["cursor"]) if "cursor" in args else {}
+        except ValueError:
+            return {"cursor_errors": CODE_INCORRECT_TYPE}, RESPONSE_BAD_REQUEST
+
+        notes, more_notes, note_position = _query_page(note_query, Note.date_created, Note.note_id,
+                                                       positions.get("notes"), limit)
+        note_contents, more_note_contents, note_content_position = _query_page(
+            note_content_query, NoteContent.date_created, NoteContent.note_content_id,
+            positions.get("note_contents"), limit)
+
+        if more_notes or more_note_contents:
+            cursor = _encode_cursor({"notes": note_position, "note_contents": note_content_position})
+        else:
+            cursor = None
+
+        notes, note_contents = _serialize_rows(notes, note_contents)
+        return {'notes': notes,
+                'note_contents': note_contents,
+                'cursor': cursor}
+
+    def _stream(self, note_query, note_content_query):
+        # Writes the response as rows are read from the database, so that memory use does
+        # not depend on the number of rows returned
+        batch_size = app.config['SYNC_STREAM_BATCH_SIZE']
+
+        def generate():
+            yield '{"notes": ['
+            notes = note_serializer.serialize_many(note_query.yield_per(batch_size))
+            for i, note in enumerate(notes):
+                yield (", " if i > 0 else "") + json.dumps(note, sort_keys=False)
+            yield '], "note_contents": ['
+            note_contents = _serialize_note_contents(note_content_query.yield_per(batch_size))
+            for i, note_content in enumerate(note_contents):
+                yield (", " if i > 0 else "") + json.dumps(note_content, sort_keys=False)
+            yield ']}'
+
+        return Response(stream_with_context(generate()), mimetype="application/json")
 
     def get(self):
         auth_ok, auth_result = self._get_user()
@@ -92,19 +364,85 @@ class NotesEndpoint(Resource):
         else:
             user_id = auth_result
 
-        note_objects, note_content_objects = self._query_objects(user_id, request.args)
+        limit_wait = rate_limiter.take(BUDGET_GETS, user_id)
+        if limit_wait is not None:
+            return _rate_limited(limit_wait)
+
+        try:
+            wait = min(float(request.args.get("wait", 0)), app.config['LONG_POLL_MAX_WAIT'])
+        except ValueError:
+            return {"wait_errors": CODE_INCORRECT_TYPE}, RESPONSE_BAD_REQUEST
+
+        # Streams are only ever written as JSON
+        if self._is_streamed(request.args) and not request.accept_mimetypes[MEDIATYPE_JSON]:
+            abort(RESPONSE_NOT_ACCEPTABLE)
+
+        # Every insert bumps the user's change seq, so responses only change along with it.
+        # It is read before anything else, so that the data returned is never older than it.
+        if wait > 0:
+            seq = self._wait_for_change(user_id, request.args, wait)
+        else:
+            seq = self._get_change_seq(user_id)
+        # Responses differ by the representation chosen with the Accept header, and so do their tags
+        version = self._version(user_id, seq, self._mediatype(request.args))
+        headers = {"ETag": quote_etag(version, weak=True), "Vary": "Accept"}
+        if request.if_none_match.contains_weak(version):
+            return Response(status=RESPONSE_NOT_MODIFIED, headers=headers)
+
+        # Streamed responses are never cached as they are meant for histories too large to hold
+        cache_key = None
+        if response_cache.enabled and not self._is_streamed(request.args):
+            mediatype, representation = negotiate_representation()
+            # Encoded so that the arguments of different queries cannot run together
+            cache_key = "{}:{}?{}".format(seq, mediatype, urlencode(sorted(request.args.items(multi=True))))
+            body = response_cache.get(user_id, cache_key)
+            if body is not None:
+                return Response(body, mimetype=mediatype, headers=headers)
+
+        response = self._get_response(user_id, request.args, seq)
+        if isinstance(response, Response):
+            response.headers.extend(headers)
+            return response
+        elif isinstance(response, tuple):
+            # Errors are not tagged
+            return response
+        elif cache_key is not None:
+            output = representation(response, 200, headers)
+            output.mimetype = mediatype
+            response_cache.put(user_id, cache_key, output.get_data())
+            return output
+        else:
+            return response, 200, headers
+
+    def _get_response(self, user_id, args, seq):
+        if "since_seq" in args:
+            return self._get_changes(user_id, args, seq)
+
+        note_query, note_content_query = self._query_objects(user_id, args)
 
-        serialized_notes = []
-        serialized_note_contents = []
+        # Only the serialized columns are read, skipping the construction of model objects
+        note_rows = note_query.with_entities(*note_serializer.columns(Note))
+        note_content_rows = _note_content_rows(note_content_query)
 
-        for note in note_objects:
-            serialized_notes.append(note_serializer.serialize(note))
+        if self._is_streamed(args):
+            return self._stream(note_rows, note_content_rows)
+        elif not _arg_is_true(args, "head") and ("limit" in args or "cursor" in args):
+            return self._get_page(note_rows, note_content_rows, args)
 
-        for note_content in note_content_objects:
-            serialized_note_contents.append(note_content_serializer.serialize(note_content))
+        notes, note_contents = _serialize_rows(note_rows, note_content_rows)
+        return {'notes': notes,
+                'note_contents': note_contents}
 
-        return {'notes': serialized_notes,
-                'note_contents': serialized_note_contents}
+    @staticmethod
+    def _process_upload(user_id, data, delta_depth):
+        # Notes and note contents are inserted in a single transaction, committed by the caller
+        # once the note contents (which may refer to notes from the same upload) have been processed
+        note_processor = NoteProcessor(user_id=user_id)
+        note_content_processor = NoteContentProcessor(user_id=user_id, delta_depth=delta_depth)
+
+        notes_error_list = note_processor.process_batch(data["notes"], commit=False)
+        note_contents_error_list = note_content_processor.process_batch(data["note_contents"], commit=False)
+        return notes_error_list, note_contents_error_list
 
     def post(self):
         auth_ok, auth_result = self._get_user()
@@ -114,27 +452,28 @@ class NotesEndpoint(Resource):
             user_id = auth_result
 
         data = request.get_json(force=True)
-        notes_error_list = []
-        note_contents_error_list = []
 
         passed, errors = top_level_processor.process(data)
         if not passed:
             return errors, RESPONSE_BAD_REQUEST
 
-        note_processor = NoteProcessor(user_id=user_id)
-        note_content_processor = NoteContentProcessor(user_id=user_id)
+        # Uploads are charged by the number of objects they hold, and at least one
+        wait = rate_limiter.take(BUDGET_POST_ITEMS, user_id, max(1, len(data["notes"]) + len(data["note_contents"])))
+        if wait is not None:
+            return _rate_limited(wait)
 
         response = {}
 
-        for note in data["notes"]:
-            passed, errors = note_processor.process(note)
-            if not passed:
-                notes_error_list.append(errors)
-
-        for note_content in data["note_contents"]:
-            passed, errors = note_content_processor.process(note_content)
-            if not passed:
-                note_contents_error_list.append(errors)
+        try:
+            notes_error_list, note_contents_error_list = run_write(self._process_upload, user_id, data,
+                                                                   app.config['NOTE_CONTENT_DELTA_DEPTH'])
+        except UserMoved:
+            # The user's data was moved to another database while this request was being handled
+            return ({"user_errors": CODE_USER_MOVED}, RESPONSE_SERVICE_UNAVAILABLE,
+                    {"Retry-After": str(app.config['SHARD_MOVE_RETRY_AFTER'])})
+        # Uploads in which every object failed validation leave the user's data unchanged
+        if len(notes_error_list) + len(note_contents_error_list) < len(data["notes"]) + len(data["note_contents"]):
+            response_cache.invalidate(user_id)
 
         if len(notes_error_list) > 0:
             response["notes"] = notes_error_list
@@ -144,3 +483,36 @@ class NotesEndpoint(Resource):
         if len(response) > 0:
             return response, RESPONSE_PARTIAL
 
+
+class SearchEndpoint(AuthenticatedEndpoint):
+    def get(self):
+        if not database.search_enabled:
+            abort(RESPONSE_NOT_FOUND)
+
+        auth_ok, auth_result = self._get_user()
+        if not auth_ok:
+            return auth_result
+        else:
+            user_id = auth_result
+
+        wait = rate_limiter.take(BUDGET_GETS, user_id)
+        if wait is not None:
+            return _rate_limited(wait)
+
+        words = parse_query(request.args.get("q", ""))
+        if len(words) == 0:
+            return {"q_errors": CODE_MISSING}, RESPONSE_BAD_REQUEST
+        try:
+            limit = min(int(request.args.get("limit", app.config['SEARCH_PAGE_SIZE_MAX'])),
+                        app.config['SEARCH_PAGE_SIZE_MAX'])
+            offset = int(request.args.get("offset", 0))
+        except ValueError:
+            return {"limit_errors": CODE_INCORRECT_TYPE}, RESPONSE_BAD_REQUEST
+        if limit < 1 or offset < 0:
+            return {"limit_errors": CODE_INCORRECT_TYPE}, RESPONSE_BAD_REQUEST
+
+        # One more row than asked for is read to tell whether there is a next page
+        query = search_note_contents(user_id, words, latest=_arg_is_true(request.args, "latest"))
+        rows = _note_content_rows(query).offset(offset).limit(limit + 1).all()
+        return {'note_contents': list(_serialize_note_contents(rows[:limit])),
+                'offset': offset + limit if len(rows) > limit else None}
@@ -15,18 +15,198 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+import asyncio
+import threading
+from contextvars import ContextVar
+from time import perf_counter
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.util import await_only
+from tuhi_flask.metrics import metrics
 
-engine = create_engine('sqlite:///../test.db', convert_unicode=True)
-db_session = scoped_session(sessionmaker(autocommit=False,
-                                         autoflush=False,
-                                         bind=engine))
+# Created from the application's configuration by init_engine()
+engine = None
+# Engine used by the single writer thread in SQLite performance mode, None otherwise
+write_engine = None
+# Engine used by requests handled on an event loop by tuhi_flask.asgi, created by init_async_engine()
+async_engine = None
+
+# Maximum number of values bound into a single IN (...) clause by queries over many ids
+# (SQLite caps the number of parameters in a statement)
+IN_CLAUSE_CHUNK_SIZE = 500
+
+# With per-user sharding (DATABASE_SHARDS), the engines of each shard by name, like the above.
+# The default database (DATABASE_URL) holds the data of the users not assigned to any shard, and
+# the users table of every user, whose shard column tells where the rest of their data is.
+shard_engines = {}
+shard_write_engines = {}
+shard_async_engines = {}
+
+# Whether notes are indexed for full-text search (tuhi_flask.search), set by init_engine() from
+# SEARCH_ENABLED. Only the databases in SEARCH_DIALECTS implement it.
+search_enabled = False
+SEARCH_DIALECTS = ('sqlite', 'postgresql')
+
+# Name of the shard holding the data of the user a request is being handled for, None for the
+# default database. Set by tuhi_flask.sharding.use_user_shard() once the user is known.
+current_shard = ContextVar("current_shard", default=None)
+
+# While tuhi_flask.asgi handles a request, set to an object identifying it. Such requests share
+# the event loop's thread, so they are given sessions of their own (bound to async_engine)
+# instead of one per thread.
+async_scope = ContextVar("async_scope", default=None)
+
+def _session_scope():
+    scope = async_scope.get()
+    return threading.get_ident() if scope is None else scope
+
+class RoutingSession(Session):
+    # Sends all statements to the current shard, if any. Sessions with an explicit bind, like
+    # those of group-commit writers, are left as they are (writers are per shard).
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        shard = current_shard.get()
+        if shard is not None and not self.info.get("explicit_bind"):
+            if self.info.get("async"):
+                return shard_async_engines[shard].sync_engine
+            return shard_engines[shard]
+        return super(RoutingSession, self).get_bind(mapper, clause=clause, **kwargs)
+
+_session_factory = sessionmaker(class_=RoutingSession,
+                                autocommit=False,
+                                autoflush=False)
+
+def _create_session(**kwargs):
+    if "bind" in kwargs:
+        kwargs["info"] = {"explicit_bind": True}
+    elif async_scope.get() is not None:
+        kwargs["bind"] = async_engine.sync_engine
+        kwargs["info"] = {"async": True}
+    return _session_factory(**kwargs)
+
+db_session = scoped_session(_create_session, scopefunc=_session_scope)
 Base = declarative_base()
 Base.query = db_session.query_property()
 
+def _configure_sqlite_engine(engine, pragmas, begin_statement):
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        # Stop pysqlite from issuing its own BEGIN statements, so that transactions
+        # (and savepoints) are delimited by SQLAlchemy alone
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def on_begin(connection):
+        connection.exec_driver_sql(begin_statement)
+
+def _instrument_engine(engine):
+    # The start time is kept on the statement's execution context, which is discarded along with
+    # it when the statement fails and after_cursor_execute is never called
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context.metrics_start = perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        metrics.observe_sql(perf_counter() - context.metrics_start)
+
+def _engine_options(url, config):
+    options = {'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+               'pool_pre_ping': config['DATABASE_POOL_PRE_PING']}
+    if url.get_backend_name() != 'sqlite':
+        # SQLite databases are not given a sized connection pool by SQLAlchemy
+        options['pool_size'] = config['DATABASE_POOL_SIZE']
+        options['max_overflow'] = config['DATABASE_MAX_OVERFLOW']
+    return options
+
+def _create_engines(url, config):
+    # Returns a tuple of the form (engine, write_engine) for the database at url
+    options = _engine_options(url, config)
+    engine = create_engine(url, convert_unicode=True, **options)
+    write_engine = None
+    if url.get_backend_name() == 'sqlite' and config['SQLITE_PERFORMANCE_MODE']:
+        _configure_sqlite_engine(engine, config['SQLITE_PRAGMAS'], "BEGIN")
+        # The writer takes the write lock as soon as it begins a transaction, so that what it
+        # reads while validating cannot be made stale by another process writing meanwhile
+        write_engine = create_engine(url, convert_unicode=True, **options)
+        _configure_sqlite_engine(write_engine, config['SQLITE_PRAGMAS'], "BEGIN IMMEDIATE")
+
+    if config['METRICS_ENABLED']:
+        # Listeners are only added when enabled, so that statements are not slowed down otherwise
+        for instrumented_engine in (engine, write_engine):
+            if instrumented_engine is not None:
+                _instrument_engine(instrumented_engine)
+    return engine, write_engine
+
+def init_engine(config):
+    global engine, write_engine, search_enabled
+    engine, write_engine = _create_engines(make_url(config['DATABASE_URL']), config)
+    shard_engines.clear()
+    shard_write_engines.clear()
+    for name, url in (config['DATABASE_SHARDS'] or {}).items():
+        shard_engines[name], shard_write_engines[name] = _create_engines(make_url(url), config)
+
+    search_enabled = config['SEARCH_ENABLED']
+    if search_enabled:
+        for search_engine in [engine] + list(shard_engines.values()):
+            if search_engine.dialect.name not in SEARCH_DIALECTS:
+                raise ValueError("Full-text search is not supported on {}, set SEARCH_ENABLED = False"
+                                 .format(search_engine.dialect.name))
+
+    db_session.remove()
+    _session_factory.configure(bind=engine)
+    return engine
+
+# Drivers used by the async engine for each backend, when ASYNC_DATABASE_URL is not set
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite',
+                 'postgresql': 'asyncpg'}
+
+def _async_url(url):
+    url = make_url(url)
+    return url.set(drivername="{}+{}".format(url.get_backend_name(), ASYNC_DRIVERS[url.get_backend_name()]))
+
+def _create_async_engine(url, config):
+    async_engine = create_async_engine(url, **_engine_options(url, config))
+    if url.get_backend_name() == 'sqlite' and config['SQLITE_PERFORMANCE_MODE']:
+        _configure_sqlite_engine(async_engine.sync_engine, config['SQLITE_PRAGMAS'], "BEGIN")
+    if config['METRICS_ENABLED']:
+        _instrument_engine(async_engine.sync_engine)
+    return async_engine
+
+def init_async_engine(config):
+    global async_engine
+    if config['ASYNC_DATABASE_URL'] is not None:
+        async_engine = _create_async_engine(make_url(config['ASYNC_DATABASE_URL']), config)
+    else:
+        async_engine = _create_async_engine(_async_url(config['DATABASE_URL']), config)
+    shard_async_engines.clear()
+    for name, url in (config['DATABASE_SHARDS'] or {}).items():
+        shard_async_engines[name] = _create_async_engine(_async_url(url), config)
+    return async_engine
+
+def all_engines():
+    # Every engine created so far, for all databases
+    engines = [engine, write_engine] + list(shard_engines.values()) + list(shard_write_engines.values())
+    engines += [async_engine.sync_engine for async_engine in [async_engine] + list(shard_async_engines.values())
+                if async_engine is not None]
+    return [e for e in engines if e is not None]
+
+def run_blocking(func, *args):
+    # Returns func(*args). While handling a request on an event loop (from within a greenlet, as
+    # set up by tuhi_flask.asgi), func is run in the loop's default executor, so that blocking
+    # or CPU-heavy work does not hold up the other requests.
+    if async_scope.get() is None:
+        return func(*args)
+    return await_only(asyncio.get_running_loop().run_in_executor(None, func, *args))
+
 def init_db():
     # TODO: import all modules here that might define models to properly register metadata
     Base.metadata.create_all(bind=engine)
-
+    for shard_engine in shard_engines.values():
+        Base.metadata.create_all(bind=shard_engine)
@@ -0,0 +1,176 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import zlib
+from collections import OrderedDict
+from flask import request, make_response
+from flask_restful.representations.json import output_json
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MEDIATYPE_JSON = "application/json"
+MEDIATYPE_COLUMNS_JSON = "application/vnd.tuhi.columns+json"
+MEDIATYPE_MSGPACK = "application/msgpack"
+
+
+def _to_columns(data):
+    # Transposes every list of objects in a response into an object holding one array per field,
+    # so that field names are sent once per list instead of once per object.
+    # An empty list becomes an empty object.
+    if not isinstance(data, dict):
+        return data
+    columnar = {}
+    for key, val in data.items():
+        if isinstance(val, list) and len(val) > 0 and all(isinstance(item, dict) for item in val):
+            columnar[key] = OrderedDict((field, [item.get(field) for item in val]) for field in val[0])
+        elif isinstance(val, list) and len(val) == 0:
+            columnar[key] = {}
+        else:
+            columnar[key] = val
+    return columnar
+
+def output_columns_json(data, code, headers=None):
+    return output_json(_to_columns(data), code, headers)
+
+def output_msgpack(data, code, headers=None):
+    response = make_response(msgpack.packb(data, use_bin_type=True), code)
+    response.headers.extend(headers or {})
+    return response
+
+
+# Representations selectable with the Accept header, JSON being the default
+representations = OrderedDict([(MEDIATYPE_JSON, output_json),
+                               (MEDIATYPE_COLUMNS_JSON, output_columns_json)])
+if msgpack is not None:
+    representations[MEDIATYPE_MSGPACK] = output_msgpack
+
+def negotiate_representation():
+    # Returns a tuple of the form (mediatype, representation function) for the current request,
+    # chosen the same way as flask-restful chooses among the representations registered with it
+    mediatype = request.accept_mimetypes.best_match(representations, default=MEDIATYPE_JSON)
+    return mediatype, representations.get(mediatype, output_json)
+
+
+def _gzip_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def _deflate_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+def _zstd_compressor(level):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+# Content codings in order of preference when a client accepts several equally
+compressors = OrderedDict([("gzip", _gzip_compressor), ("deflate", _deflate_compressor)])
+_decompression_errors = (zlib.error, ValueError)
+if zstandard is not None:
+    compressors["zstd"] = _zstd_compressor
+    compressors.move_to_end("zstd", last=False)
+    _decompression_errors += (zstandard.ZstdError,)
+
+
+def _compress_chunks(chunks, compressor):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class ResponseCompressor(object):
+    # Compresses successful responses with the best content coding the client accepts.
+    # Registered as an after_request function.
+
+    def __init__(self, min_size, level):
+        self.min_size = min_size
+        self.level = level
+
+    def __call__(self, response):
+        if not 200 <= response.status_code < 300 or "Content-Encoding" in response.headers:
+            return response
+        response.vary.add("Accept-Encoding")
+
+        encoding = request.accept_encodings.best_match(list(compressors))
+        if encoding is None:
+            return response
+        compressor = compressors[encoding](self.level)
+
+        if response.is_streamed:
+            response.response = _compress_chunks(response.response, compressor)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(compressor.compress(data) + compressor.flush())
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+
+def _decompress(encoding, data, max_size):
+    # Returns the decompressed data, or None if it is larger than max_size
+    if encoding == "zstd":
+        decompressed = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read(max_size + 1)
+        return decompressed if len(decompressed) <= max_size else None
+    wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+    decompressor = zlib.decompressobj(wbits)
+    decompressed = decompressor.decompress(data, max_size)
+    return decompressed if not decompressor.unconsumed_tail else None
+
+
+class RequestDecompressor(object):
+    # WSGI middleware decompressing request bodies sent with a Content-Encoding, before Flask
+    # reads them. Bodies larger than max_size once decompressed are rejected.
+
+    def __init__(self, wsgi_app, max_size):
+        self.wsgi_app = wsgi_app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "identity").strip().lower()
+        if encoding == "identity":
+            return self.wsgi_app(environ, start_response)
+        if encoding not in compressors:
+            return UnsupportedMediaType()(environ, start_response)
+
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return BadRequest()(environ, start_response)
+        try:
+            data = _decompress(encoding, environ["wsgi.input"].read(length), self.max_size)
+        except _decompression_errors:
+            return BadRequest()(environ, start_response)
+        if data is None:
+            return RequestEntityTooLarge()(environ, start_response)
+
+        environ["wsgi.input"] = io.BytesIO(data)
+        environ["CONTENT_LENGTH"] = str(len(data))
+        del environ["HTTP_CONTENT_ENCODING"]
+        return self.wsgi_app(environ, start_response)
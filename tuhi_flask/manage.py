@@ -15,9 +15,35 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import gzip
+import io
+import json
+import sys
+from contextlib import contextmanager
+from sqlalchemy import and_
 from tuhi_flask.app import app as main_app
 from tuhi_flask.models import *
-from tuhi_flask.database import init_db
+from tuhi_flask.database import init_db, db_session, current_shard
+from tuhi_flask.migrations import migrate_db
+from tuhi_flask.processors import NoteProcessor, NoteContentProcessor
+from tuhi_flask.response_codes import CODE_ALREADY_EXISTS_CONFLICT
+from tuhi_flask.revisions import expand_rows
+from tuhi_flask.serializers import NoteSerializer, NoteContentSerializer
+from tuhi_flask.sharding import use_user_shard
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Exports are newline-delimited JSON: a {"record": "user"} line for each user, followed by the
+# user's notes and then their note contents ({"record": "note"} and {"record": "note_content"}
+# lines), each in the form POST /notes accepts them, with the full text of note contents stored
+# as deltas. They are gzip or zstd compressed, and read and written a line at a time.
+EXPORT_BATCH_SIZE = 1000
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 
 def init():
     with main_app.app_context():
@@ -27,5 +53,199 @@ def init():
         db_session.add(u)
         db_session.commit()
 
+def migrate():
+    with main_app.app_context():
+        migrate_db()
+
+
+def _add_filter_arguments(parser):
+    parser.add_argument("--user", action="append", dest="users", metavar="USERNAME",
+                        help="only include this user (can be repeated)")
+    parser.add_argument("--since", type=int, help="only include objects created at or after this time "
+                                                  "(seconds from epoch)")
+    parser.add_argument("--until", type=int, help="only include objects created before this time")
+
+def _in_range(date_created, args):
+    return ((args.since is None or date_created >= args.since) and
+            (args.until is None or date_created < args.until))
+
+def _date_filter(column, args):
+    conditions = []
+    if args.since is not None:
+        conditions.append(column >= args.since)
+    if args.until is not None:
+        conditions.append(column < args.until)
+    return and_(*conditions)
+
+@contextmanager
+def _open_output(path, compression):
+    raw = sys.stdout.buffer if path == "-" else open(path, "wb")
+    if compression == "gzip":
+        stream = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+    elif compression == "zstd":
+        stream = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+    else:
+        stream = raw
+    try:
+        output = io.TextIOWrapper(stream, encoding="utf-8")
+        yield output
+        output.detach()
+        if stream is not raw:
+            # Ends the compressed stream, leaving raw open
+            stream.close()
+        raw.flush()
+    finally:
+        if raw is not sys.stdout.buffer:
+            raw.close()
+
+@contextmanager
+def _open_input(path):
+    # The compression is told from the data itself
+    raw = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        magic = raw.peek(4)[:4]
+        if magic[:2] == GZIP_MAGIC:
+            stream = gzip.GzipFile(fileobj=raw, mode="rb")
+        elif magic == ZSTD_MAGIC:
+            if zstandard is None:
+                raise SystemExit("zstandard is required to import zstd compressed exports")
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+        else:
+            stream = raw
+        records = io.TextIOWrapper(stream, encoding="utf-8")
+        yield records
+        records.detach()
+    finally:
+        if raw is not sys.stdin.buffer:
+            raw.close()
+
+
+def _export_user(output, user, args, counts):
+    output.write(json.dumps({"record": "user", "username": user.username, "password_hash": user.password_hash}) + "\n")
+    use_user_shard(user.user_id)
+    try:
+        note_serializer = NoteSerializer()
+        note_rows = db_session.query(*note_serializer.columns(Note)) \
+            .filter(Note.user_id == user.user_id, _date_filter(Note.date_created, args)) \
+            .order_by(Note.date_created, Note.note_id).yield_per(EXPORT_BATCH_SIZE)
+        for note in note_serializer.serialize_many(note_rows):
+            output.write(json.dumps(dict(note, record="note")) + "\n")
+            counts["notes"] += 1
+
+        # In order of creation, so that revisions are stored as deltas again on import
+        note_content_serializer = NoteContentSerializer()
+        note_content_rows = db_session.query(*note_content_serializer.columns(NoteContent), NoteContent.data_base_id) \
+            .filter(NoteContent.user_id == user.user_id, _date_filter(NoteContent.date_created, args)) \
+            .order_by(NoteContent.date_created, NoteContent.note_content_id).yield_per(EXPORT_BATCH_SIZE)
+        rows = expand_rows(note_content_rows, NoteContentSerializer._fields.index("note_content_id"),
+                           NoteContentSerializer._fields.index("data"), EXPORT_BATCH_SIZE)
+        for note_content in note_content_serializer.serialize_many(rows):
+            output.write(json.dumps(dict(note_content, record="note_content")) + "\n")
+            counts["note_contents"] += 1
+    finally:
+        db_session.rollback()
+        current_shard.set(None)
+
+def export_data(argv=None):
+    parser = argparse.ArgumentParser(description="Exports users, notes and note contents as compressed NDJSON")
+    parser.add_argument("output", help="file to write, - for standard output")
+    parser.add_argument("--compression", choices=("gzip", "zstd", "none"), default="gzip")
+    _add_filter_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.compression == "zstd" and zstandard is None:
+        parser.error("zstandard is required for zstd compression")
+
+    counts = {"users": 0, "notes": 0, "note_contents": 0}
+    with main_app.app_context(), _open_output(args.output, args.compression) as output:
+        user_query = db_session.query(User.user_id, User.username, User.password_hash)
+        if args.users is not None:
+            user_query = user_query.filter(User.username.in_(args.users))
+        # Users are listed up front, as the connection is used for other queries while exporting
+        for user in user_query.order_by(User.user_id).all():
+            _export_user(output, user, args, counts)
+            counts["users"] += 1
+    print("Exported {users} users, {notes} notes and {note_contents} note contents".format(**counts), file=sys.stderr)
+
+
+class _Importer(object):
+    # Imports the records of an export for one user after the other, validating and inserting
+    # notes and note contents like uploads are, batch_size records per transaction
+
+    def __init__(self, delta_depth, batch_size):
+        self.delta_depth = delta_depth
+        self.batch_size = batch_size
+        self.user_id = None
+        self.batch_type = None
+        self.batch = []
+        self.counts = {"users": 0, "imported": 0, "existing": 0, "rejected": 0}
+
+    def add_user(self, record):
+        self.flush()
+        current_shard.set(None)
+        user = db_session.query(User.user_id).filter(User.username == record["username"]).one_or_none()
+        if user is None:
+            result = db_session.execute(User.__table__.insert().values(username=record["username"],
+                                                                       password_hash=record["password_hash"]))
+            db_session.commit()
+            self.user_id = result.inserted_primary_key[0]
+        else:
+            # Users that already exist keep their password
+            (self.user_id,) = user
+        use_user_shard(self.user_id)
+        self.counts["users"] += 1
+
+    def add(self, record_type, record):
+        if self.user_id is None:
+            raise SystemExit("The export does not start with a user record")
+        if record_type != self.batch_type:
+            self.flush()
+            self.batch_type = record_type
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        if self.batch_type == "note":
+            processor = NoteProcessor(user_id=self.user_id)
+        else:
+            processor = NoteContentProcessor(user_id=self.user_id, delta_depth=self.delta_depth)
+        errors = processor.process_batch(self.batch, commit=False)
+        db_session.commit()
+        existing = sum(1 for error in errors if CODE_ALREADY_EXISTS_CONFLICT in error.values())
+        self.counts["existing"] += existing
+        self.counts["rejected"] += len(errors) - existing
+        self.counts["imported"] += len(self.batch) - len(errors)
+        self.batch = []
+
+def import_data(argv=None):
+    parser = argparse.ArgumentParser(description="Imports users, notes and note contents exported by "
+                                                 "tuhi-flask-export. Objects that already exist are skipped.")
+    parser.add_argument("input", help="file to read, - for standard input")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="objects per transaction")
+    _add_filter_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with main_app.app_context(), _open_input(args.input) as records:
+        importer = _Importer(main_app.config['NOTE_CONTENT_DELTA_DEPTH'], args.batch_size)
+        skipping = False
+        try:
+            for line in records:
+                record = json.loads(line)
+                record_type = record.pop("record")
+                if record_type == "user":
+                    skipping = args.users is not None and record["username"] not in args.users
+                    if not skipping:
+                        importer.add_user(record)
+                elif not skipping and _in_range(record["date_created"], args):
+                    importer.add(record_type, record)
+            importer.flush()
+        finally:
+            current_shard.set(None)
+    print("Imported {imported} objects of {users} users, skipped {existing} already present and rejected "
+          "{rejected} invalid ones".format(**importer.counts), file=sys.stderr)
+
+
 if __name__ == "__main__":
     init()
\ No newline at end of file
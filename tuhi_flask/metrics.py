@@ -0,0 +1,161 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+from threading import Lock
+from time import perf_counter
+from flask import g, request, has_request_context, Response
+from flask_restful import Resource
+from tuhi_flask.cache import response_cache
+from tuhi_flask.ratelimit import rate_limiter
+
+METRIC_PREFIX = "tuhi_flask_"
+
+# Help text and type of each metric, in the order they are rendered
+METRICS = (
+    ("requests_total", "counter", "Requests handled, by method, endpoint and status"),
+    ("request_seconds", "summary", "Time spent handling requests, by method and endpoint"),
+    ("phase_seconds", "summary", "Time spent in instrumented phases of request handling"),
+    ("sql_statements_total", "counter", "SQL statements executed"),
+    ("sql_seconds_total", "counter", "Time spent executing SQL statements"),
+    ("rows_returned_total", "counter", "Notes and note contents returned by GET requests, by type"),
+    ("response_cache_total", "counter", "Response cache operations, by outcome"),
+    ("rate_limit_total", "counter", "Rate limiter decisions, by budget and outcome"),
+    ("compaction_revisions_deleted_total", "counter", "Note contents deleted by the compaction job"),
+    ("compaction_bytes_reclaimed_total", "counter", "Bytes of note content data freed by the compaction job"),
+)
+
+
+class Metrics(object):
+    # Process-wide counters and timings, exposed in the Prometheus text format by /metrics.
+    # While disabled (the default) recording is skipped entirely, so instrumented code pays
+    # for little more than a check of the enabled attribute.
+    #
+    # Each metric is a mapping from a tuple of (label, value) pairs to a counter value or,
+    # for summaries, to a [count, sum] pair. While a request is being handled, phase and SQL
+    # timings are also collected for it in flask.g, for the Server-Timing header.
+
+    def __init__(self):
+        self._lock = Lock()
+        self.configure(False, False)
+
+    def configure(self, enabled, server_timing):
+        self.enabled = enabled
+        self.server_timing = enabled and server_timing
+        with self._lock:
+            self._values = {name: {} for name, _, _ in METRICS}
+
+    def count(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            if key in values:
+                values[key][0] += 1
+                values[key][1] += seconds
+            else:
+                values[key] = [1, seconds]
+
+    def observe_phase(self, phase, seconds):
+        self.observe("phase_seconds", seconds, phase=phase)
+        if self.server_timing and has_request_context() and "metrics_phases" in g:
+            g.metrics_phases[phase] = g.metrics_phases.get(phase, 0) + seconds
+
+    def observe_sql(self, seconds):
+        self.count("sql_statements_total")
+        self.count("sql_seconds_total", seconds)
+        if self.server_timing and has_request_context() and "metrics_sql" in g:
+            g.metrics_sql[0] += 1
+            g.metrics_sql[1] += seconds
+
+    def start_request(self):
+        # Registered as a before_request function
+        g.metrics_start = perf_counter()
+        if self.server_timing:
+            g.metrics_phases = {}
+            g.metrics_sql = [0, 0.0]
+
+    def finish_request(self, response):
+        # Registered as an after_request function. Streamed responses are timed until their
+        # first byte only.
+        elapsed = perf_counter() - g.metrics_start
+        endpoint = request.endpoint or "none"
+        self.count("requests_total", method=request.method, endpoint=endpoint, status=str(response.status_code))
+        self.observe("request_seconds", elapsed, method=request.method, endpoint=endpoint)
+
+        if self.server_timing:
+            timings = ['{};dur={:.3f}'.format(phase, 1000 * seconds) for phase, seconds in g.metrics_phases.items()]
+            statements, seconds = g.metrics_sql
+            timings.append('sql;dur={:.3f};desc="{} statements"'.format(1000 * seconds, statements))
+            timings.append('total;dur={:.3f}'.format(1000 * elapsed))
+            response.headers["Server-Timing"] = ", ".join(timings)
+        return response
+
+    def render(self):
+        # Returns all metrics in the Prometheus text exposition format
+        with self._lock:
+            values = {name: dict(metric_values) for name, metric_values in self._values.items()}
+        values["response_cache_total"] = {(("outcome", outcome),): value
+                                          for outcome, value in response_cache.stats().items()}
+        values["rate_limit_total"] = {(("budget", budget), ("outcome", outcome)): value
+                                      for (budget, outcome), value in rate_limiter.stats().items()}
+
+        lines = []
+        for name, metric_type, description in METRICS:
+            full_name = METRIC_PREFIX + name
+            lines.append("# HELP {} {}".format(full_name, description))
+            lines.append("# TYPE {} {}".format(full_name, metric_type))
+            for key, value in sorted(values[name].items()):
+                labels = ",".join('{}="{}"'.format(label, label_value) for label, label_value in key)
+                labels = "{" + labels + "}" if labels else ""
+                if metric_type == "summary":
+                    lines.append("{}_count{} {}".format(full_name, labels, value[0]))
+                    lines.append("{}_sum{} {!r}".format(full_name, labels, float(value[1])))
+                else:
+                    lines.append("{}{} {!r}".format(full_name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+def timed(phase, per_class=False):
+    # Decorates a function so that its calls are timed as the given phase while metrics are enabled.
+    # With per_class, the decorated function must be a method and the phase is suffixed with the
+    # name of the class of the instance it is called on.
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                name = phase + "." + type(args[0]).__name__ if per_class else phase
+                metrics.observe_phase(name, perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+class MetricsEndpoint(Resource):
+    def get(self):
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
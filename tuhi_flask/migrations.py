@@ -0,0 +1,125 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import inspect, text
+from tuhi_flask import database
+from tuhi_flask.database import Base
+from tuhi_flask.models import CHANGE_TYPE_NOTE, CHANGE_TYPE_NOTE_CONTENT  # also registers all tables
+from tuhi_flask.search import index_note_rows
+
+# Each migration brings an existing database up to date with one schema change made after
+# its tables were first created. Migrations must be idempotent as they are run on every
+# upgrade, including against databases that were created with the current schema.
+
+
+def _add_column(connection, table, column, definition):
+    # Adds the column to the table unless it already exists, returning whether it was added
+    columns = [existing["name"] for existing in inspect(connection).get_columns(table)]
+    if column in columns:
+        return False
+    connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition)))
+    return True
+
+
+def _add_note_contents_user_id(connection):
+    if not _add_column(connection, "note_contents", "user_id", "INTEGER REFERENCES users (user_id)"):
+        return
+    connection.execute(text("UPDATE note_contents SET user_id = "
+                            "(SELECT notes.user_id FROM notes WHERE notes.note_id = note_contents.note_id)"))
+
+
+def _add_users_change_seq(connection):
+    if not _add_column(connection, "users", "change_seq", "INTEGER NOT NULL DEFAULT 0"):
+        return
+    # Existing notes and note contents are logged in order of creation
+    connection.execute(text("INSERT INTO changes (user_id, seq, object_type, object_id) "
+                            "SELECT user_id, ROW_NUMBER() OVER "
+                            "(PARTITION BY user_id ORDER BY date_created, object_type, object_id), "
+                            "object_type, object_id FROM ("
+                            "SELECT user_id, date_created, :note AS object_type, note_id AS object_id "
+                            "FROM notes UNION ALL "
+                            "SELECT user_id, date_created, :note_content, note_content_id "
+                            "FROM note_contents) AS existing"),
+                       {"note": CHANGE_TYPE_NOTE, "note_content": CHANGE_TYPE_NOTE_CONTENT})
+    connection.execute(text("UPDATE users SET change_seq = "
+                            "(SELECT COALESCE(MAX(seq), 0) FROM changes WHERE changes.user_id = users.user_id)"))
+
+
+def _add_note_contents_delta_columns(connection):
+    _add_column(connection, "note_contents", "data_base_id", "CHAR(36)")
+    _add_column(connection, "note_contents", "data_depth", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _fill_current_note_contents(connection):
+    if connection.execute(text("SELECT COUNT(*) FROM current_note_contents")).scalar() > 0:
+        return
+    connection.execute(text("INSERT INTO current_note_contents (note_id, user_id, note_content_id, date_created) "
+                            "SELECT note_id, user_id, note_content_id, date_created FROM ("
+                            "SELECT note_id, user_id, note_content_id, date_created, ROW_NUMBER() OVER "
+                            "(PARTITION BY note_id ORDER BY date_created DESC, note_content_id DESC) AS rank "
+                            "FROM note_contents) AS ranked WHERE rank = 1"))
+
+
+def _fill_note_content_search(connection):
+    # The table itself is created by create_all()
+    if not database.search_enabled:
+        return
+    if connection.execute(text("SELECT COUNT(*) FROM note_content_search")).scalar() > 0:
+        return
+    result = connection.execution_options(stream_results=True).execute(
+        text("SELECT note_content_id, note_id, user_id, data, data_base_id FROM note_contents ORDER BY note_id"))
+    note_rows = []
+    for row in result:
+        if len(note_rows) > 0 and row[1] != note_rows[0][1]:
+            index_note_rows(connection, note_rows)
+            note_rows = []
+        note_rows.append(tuple(row))
+    if len(note_rows) > 0:
+        index_note_rows(connection, note_rows)
+
+
+def _add_users_shard(connection):
+    _add_column(connection, "users", "shard", "VARCHAR")
+
+
+MIGRATIONS = (
+    _add_note_contents_user_id,
+    _add_users_change_seq,
+    _add_note_contents_delta_columns,
+    _fill_current_note_contents,
+    _fill_note_content_search,
+    _add_users_shard,
+)
+
+
+def _create_missing_indexes(connection):
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = set(index["name"] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+def migrate_db():
+    for engine in [database.engine] + list(database.shard_engines.values()):
+        with engine.begin() as connection:
+            # Tables that did not exist yet are created with their current schema
+            Base.metadata.create_all(bind=connection)
+            for migration in MIGRATIONS:
+                migration(connection)
+            _create_missing_indexes(connection)
@@ -16,15 +16,24 @@
 # along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
 
 from flask import current_app as app
-from sqlalchemy import Column, Integer, String, CHAR, Text, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, CHAR, Text, Boolean, ForeignKey, Index, DDL, event
 from werkzeug.security import generate_password_hash, check_password_hash
-from tuhi_flask.database import Base
+from tuhi_flask import database
+from tuhi_flask.database import Base, run_blocking
+from tuhi_flask.auth import credential_cache
+
+# Values of Change.object_type
+CHANGE_TYPE_NOTE = 0
+CHANGE_TYPE_NOTE_CONTENT = 1
 
 class User(Base):
     __tablename__ = 'users'
     user_id = Column(Integer, primary_key=True)
     username = Column(String, unique=True, index=True)
     password_hash = Column(String)
+    change_seq = Column(Integer, nullable=False, default=0, server_default='0')  # Last Change.seq assigned
+    # Name of the shard holding the user's data if not this database, see tuhi_flask.sharding
+    shard = Column(String, nullable=True)
 
     def __init__(self, username, password):
         self.username = username
@@ -34,22 +43,77 @@ class User(Base):
         self.password_hash = generate_password_hash(password,
                                                     method=app.config['PASSWORD_HASH_METHOD'],
                                                     salt_length=app.config['PASSWORD_SALT_LENGTH'])
+        credential_cache.invalidate(self.username)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # The KDF is slow by design, so it must not hold up an event loop
+        return run_blocking(check_password_hash, self.password_hash, password)
 
 
 class Note(Base):
     __tablename__ = 'notes'
+    __table_args__ = (Index('ix_notes_user_id_date_created', 'user_id', 'date_created'),)
     note_id = Column(CHAR(36), primary_key=True)
     user_id = Column(Integer, ForeignKey('users.user_id'), index=True)
-    date_created = Column(Integer, index=True)  # Seconds from epoch
+    date_created = Column(BigInteger, index=True)  # Seconds from epoch
 
 
 class NoteContent(Base):
     __tablename__ = 'note_contents'
+    __table_args__ = (Index('ix_note_contents_user_id_date_created', 'user_id', 'date_created'),)
     note_content_id = Column(CHAR(36), primary_key=True)
     note_id = Column(CHAR(36), ForeignKey('notes.note_id'), index=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'))  # Denormalized from notes.user_id
     type = Column(Integer)
-    data = Column(Text)
-    date_created = Column(Integer, index=True)  # Seconds from epoch
+    data = Column(Text)  # Full text, or a delta if data_base_id is set (see tuhi_flask.revisions)
+    data_base_id = Column(CHAR(36))  # Revision of the same note that data is a delta against
+    data_depth = Column(Integer, nullable=False, default=0, server_default='0')  # Deltas since a full text
+    date_created = Column(BigInteger, index=True)  # Seconds from epoch
+
+
+class CurrentNoteContent(Base):
+    # Points at the latest revision (by date_created, then note_content_id) of each note's contents,
+    # kept up to date by NoteContentProcessor as note contents are inserted
+    __tablename__ = 'current_note_contents'
+    note_id = Column(CHAR(36), ForeignKey('notes.note_id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'), index=True)
+    note_content_id = Column(CHAR(36), ForeignKey('note_contents.note_content_id'))
+    date_created = Column(BigInteger)  # Seconds from epoch, copied from the note content
+
+
+# Full-text index of the full text of each note content (even those stored as deltas), kept up
+# to date by NoteContentProcessor and queried by tuhi_flask.search. Its definition depends on the
+# database, so it is created along with the models' tables rather than declared as a model.
+# SQLite: an FTS5 table, in which user_id is indexed too so that matches can be scoped to a user.
+# PostgreSQL: a table of tsvector documents with a GIN index.
+# It is left out with SEARCH_ENABLED = False.
+SEARCH_TABLE_DDL = (
+    ('sqlite', "CREATE VIRTUAL TABLE IF NOT EXISTS note_content_search USING fts5("
+               "data, user_id, note_content_id UNINDEXED, tokenize = 'unicode61')"),
+    ('postgresql', "CREATE TABLE IF NOT EXISTS note_content_search ("
+                   "note_content_id CHAR(36) PRIMARY KEY REFERENCES note_contents (note_content_id), "
+                   "document TSVECTOR NOT NULL)"),
+    ('postgresql', "CREATE INDEX IF NOT EXISTS ix_note_content_search_document "
+                   "ON note_content_search USING GIN (document)"),
+)
+def _search_enabled(ddl, target, bind, **kwargs):
+    return database.search_enabled
+
+for dialect, statement in SEARCH_TABLE_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect=dialect, callable_=_search_enabled))
+
+
+class RevokedToken(Base):
+    __tablename__ = 'revoked_tokens'
+    token_id = Column(CHAR(36), primary_key=True)
+    expires = Column(BigInteger, index=True)  # Seconds from epoch
+
+
+class Change(Base):
+    # Every note and note content inserted is logged here under a sequence number that is
+    # assigned by the server and increases monotonically for each user
+    __tablename__ = 'changes'
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    object_type = Column(Integer)  # One of the CHANGE_TYPE_* constants
+    object_id = Column(CHAR(36))
@@ -0,0 +1,204 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import atexit
+import os
+import socket
+from threading import Event, Lock, Thread
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.util import await_only
+from tuhi_flask.database import async_scope
+
+
+class Subscription(object):
+    # Waits for notifications of changes to one user's data. Created by ChangeNotifier.subscribe().
+    # While handling a request on an event loop (see tuhi_flask.asgi), waiting suspends the request
+    # instead of blocking the loop's thread.
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._loop = None
+        if async_scope.get() is None:
+            self._event = Event()
+        else:
+            self._loop = asyncio.get_running_loop()
+            self._future = self._loop.create_future()
+
+    def _set_future(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    def notify(self):
+        # May be called from any thread
+        if self._loop is None:
+            self._event.set()
+        else:
+            try:
+                self._loop.call_soon_threadsafe(self._set_future)
+            except RuntimeError:
+                pass  # The loop has been closed
+
+    def wait(self, timeout):
+        # Returns whether a notification arrived within timeout seconds, since the subscription was
+        # made or the last wait() that returned True. Notifications that arrive after it returns
+        # are for changes committed before, so callers must look for changes once it does.
+        if self._loop is None:
+            notified = self._event.wait(timeout)
+            self._event.clear()
+        else:
+            try:
+                await_only(asyncio.wait_for(asyncio.shield(self._future), timeout))
+            except asyncio.TimeoutError:
+                pass
+            notified = self._future.done()
+            if notified:
+                self._future = self._loop.create_future()
+        return notified
+
+
+class SocketNotifyBackend(object):
+    # Relays notifications between the processes of a machine, through Unix datagram sockets
+    # bound in directory, one per process with subscribers. Publishing sends a datagram of
+    # comma-separated user ids to every other socket there. Notifications are dropped rather
+    # than waited on if a process is not keeping up with them, its waiters then time out.
+
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._lock = Lock()
+        self._pid = None
+        self._path = None
+        self._send_socket = None
+        self._send_pid = None
+
+    def listen(self, deliver):
+        # Starts passing the user ids published by other processes to deliver(), in a thread.
+        # Like the group-commit writer's, the thread is started again in forked processes.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                path = os.path.join(self._directory, "{}.sock".format(os.getpid()))
+                if os.path.exists(path):
+                    os.unlink(path)  # Left behind by a process that had the same pid
+                receive_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                receive_socket.bind(path)
+                atexit.register(os.unlink, path)
+                Thread(target=self._receive, args=(receive_socket, deliver),
+                       name="tuhi-flask-notify", daemon=True).start()
+                self._path = path
+                self._pid = os.getpid()
+
+    def _receive(self, receive_socket, deliver):
+        while True:
+            message = receive_socket.recv(65536)
+            try:
+                user_ids = [int(user_id) for user_id in message.decode("ascii").split(",")]
+            except ValueError:
+                continue
+            deliver(user_ids)
+
+    def publish(self, user_ids):
+        if self._send_pid != os.getpid():
+            self._send_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._send_socket.setblocking(False)
+            self._send_pid = os.getpid()
+
+        message = ",".join(str(user_id) for user_id in user_ids).encode("ascii")
+        own_path = self._path if self._pid == os.getpid() else None
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if path == own_path or not name.endswith(".sock"):
+                continue
+            try:
+                self._send_socket.sendto(message, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The process that bound it has exited without removing it
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except (BlockingIOError, OSError):
+                pass
+
+
+class ChangeNotifier(object):
+    # Wakes up requests waiting on changes to a user's data (GET /notes?wait=...) when a transaction
+    # logging changes for that user commits. Notifications are delivered to the waiters of this
+    # process, and through the backend (if any) to those of other processes. They only tell that
+    # something changed, so waiters must check for themselves what did, and may be woken up spuriously.
+
+    def __init__(self, backend=None):
+        self._lock = Lock()
+        self._subscriptions = {}
+        self.configure(backend)
+
+    def configure(self, backend):
+        self._backend = backend
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        if self._backend is not None:
+            self._backend.listen(self._deliver)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions[subscription.user_id]
+            subscriptions.discard(subscription)
+            if len(subscriptions) == 0:
+                del self._subscriptions[subscription.user_id]
+
+    def _deliver(self, user_ids):
+        with self._lock:
+            subscriptions = [subscription for user_id in user_ids
+                             for subscription in self._subscriptions.get(user_id, ())]
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def publish(self, user_ids):
+        self._deliver(user_ids)
+        if self._backend is not None:
+            self._backend.publish(user_ids)
+
+
+change_notifier = ChangeNotifier()
+
+def init_change_notifier(config):
+    backend = config['NOTIFY_BACKEND']
+    if backend is None:
+        change_notifier.configure(None)
+    elif backend == 'socket':
+        change_notifier.configure(SocketNotifyBackend(config['NOTIFY_SOCKET_DIR']))
+    else:
+        raise ValueError("Unknown NOTIFY_BACKEND: {}".format(backend))
+
+def mark_changed(session, user_id):
+    # Has waiters on changes to the user's data notified once the session's transaction commits
+    session.info.setdefault("changed_users", set()).add(user_id)
+
+@event.listens_for(Session, "after_commit")
+def _publish_changes(session):
+    if session.get_nested_transaction() is not None:
+        return  # Only a savepoint was released, the transaction has yet to commit
+    changed_users = session.info.pop("changed_users", None)
+    if changed_users:
+        change_notifier.publish(changed_users)
@@ -14,20 +14,23 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
-from sqlalchemy import exists
+from sqlalchemy import exists, bindparam, and_
 
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
-from tuhi_flask.database import db_session
+from tuhi_flask.auth import credential_cache
+from tuhi_flask.database import db_session, IN_CLAUSE_CHUNK_SIZE
+from tuhi_flask.metrics import timed
+from tuhi_flask.notifications import mark_changed
 from tuhi_flask.response_codes import *  # noqa
-from tuhi_flask.models import User, Note, NoteContent
+from tuhi_flask.models import User, Note, NoteContent, CurrentNoteContent, Change, CHANGE_TYPE_NOTE, \
+    CHANGE_TYPE_NOTE_CONTENT
+from tuhi_flask.revisions import encode_revisions
+from tuhi_flask.search import index_note_contents
+from tuhi_flask.sharding import UserMoved
 
 ERROR_FIELD_SUFFIX = "_errors"
 
-class UnsuccessfulProcessing(Exception):
-    def __init__(self, response):
-        self.response = response
-
 class ValidationError(Exception):
     def __init__(self, code=None, parallel_insert=None):
         self.code = code
@@ -61,6 +64,96 @@ def _validate_date(val):
         raise ValidationError(CODE_INVALID_DATE)
 
 
+def _collect_uuids(targets, field):
+    uuids = set()
+    for target in targets:
+        if isinstance(target, dict):
+            uuid = target.get(field)
+            if type(uuid) is str and len(uuid) == 36:
+                uuids.add(uuid)
+    return uuids
+
+def _query_owners(key_column, owner_column, keys):
+    # Returns a dict mapping each of the given keys that exists in the database to its owner,
+    # issuing one IN (...) query per IN_CLAUSE_CHUNK_SIZE keys
+    keys = list(keys)
+    owners = {}
+    for i in range(0, len(keys), IN_CLAUSE_CHUNK_SIZE):
+        chunk = keys[i:i + IN_CLAUSE_CHUNK_SIZE]
+        owners.update(db_session.query(key_column, owner_column).filter(key_column.in_(chunk)))
+    return owners
+
+def _record_changes(user_id, object_type, object_ids):
+    # Logs the insertion of the given objects in the current transaction. Incrementing
+    # users.change_seq first locks the user's row, so that concurrent transactions
+    # for the same user are assigned disjoint ranges of sequence numbers. Users whose row has
+    # its shard set have been moved to another database, where their changes must be made instead.
+    if len(object_ids) == 0:
+        return
+    result = db_session.execute(User.__table__.update()
+                                .where(and_(User.user_id == user_id, User.shard.is_(None)))
+                                .values(change_seq=User.change_seq + len(object_ids)))
+    if result.rowcount == 0:
+        raise UserMoved()
+    (last_seq,) = db_session.query(User.change_seq).filter(User.user_id == user_id).one()
+    first_seq = last_seq - len(object_ids) + 1
+    db_session.execute(Change.__table__.insert(),
+                       [{"user_id": user_id,
+                         "seq": first_seq + i,
+                         "object_type": object_type,
+                         "object_id": object_id} for i, object_id in enumerate(object_ids)])
+    mark_changed(db_session, user_id)
+
+def _update_current_note_contents(user_id, revisions):
+    # Takes (note_id, date_created, note_content_id) tuples of newly inserted note contents and
+    # points each note's current note content at the latest of its revisions
+    newest = {}
+    for note_id, date_created, note_content_id in revisions:
+        if note_id not in newest or (date_created, note_content_id) > newest[note_id]:
+            newest[note_id] = (date_created, note_content_id)
+
+    note_ids = list(newest)
+    current = {}
+    for i in range(0, len(note_ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = note_ids[i:i + IN_CLAUSE_CHUNK_SIZE]
+        for note_id, date_created, note_content_id in db_session.query(
+                CurrentNoteContent.note_id, CurrentNoteContent.date_created, CurrentNoteContent.note_content_id) \
+                .filter(CurrentNoteContent.note_id.in_(chunk)):
+            current[note_id] = (date_created, note_content_id)
+
+    inserts = []
+    updates = []
+    for note_id, (date_created, note_content_id) in newest.items():
+        if note_id not in current:
+            inserts.append({"note_id": note_id, "user_id": user_id,
+                            "note_content_id": note_content_id, "date_created": date_created})
+        elif (date_created, note_content_id) > current[note_id]:
+            updates.append({"current_note_id": note_id,
+                            "current_note_content_id": note_content_id,
+                            "current_date_created": date_created})
+
+    if len(inserts) > 0:
+        db_session.execute(CurrentNoteContent.__table__.insert(), inserts)
+    if len(updates) > 0:
+        db_session.execute(CurrentNoteContent.__table__.update()
+                           .where(CurrentNoteContent.note_id == bindparam("current_note_id"))
+                           .values(note_content_id=bindparam("current_note_content_id"),
+                                   date_created=bindparam("current_date_created")),
+                           updates)
+
+def _get_owner(prefetched_owners, key_column, owner_column, key):
+    # Returns the owner of the row with the given key (None if there is no such row), looking
+    # it up in the owners prefetched for a batch when there are any
+    if prefetched_owners is not None:
+        return prefetched_owners.get(key)
+    try:
+        (owner,) = db_session.query(owner_column).filter(key_column == key).one()
+    except NoResultFound:
+        return None
+    else:
+        return owner
+
+
 class ObjectProcessor(object):
     # Subclasses should define validation methods of the form _validate_<field_name>():
     # these methods should raise the appropriate ValidationError with error code on validation failures
@@ -87,6 +180,32 @@ class ObjectProcessor(object):
     # Counter of uses to enforce single-use
     _num_uses = 0
 
+    # State loaded by _prefetch() while a batch is being processed, None otherwise
+    _prefetched = None
+
+    # Computed once for each subclass when it is defined from _fields and _fields_reflected_on_error:
+    # a tuple of (field, error field, validation function) for each field to validate (None if there
+    # are no fields) and a tuple of (field, error field) for each field reflected on error
+    _field_plan = None
+    _reflect_plan = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super(ObjectProcessor, cls).__init_subclass__(**kwargs)
+        cls._field_plan = cls._compile_field_plan(cls._fields)
+        cls._reflect_plan = cls._compile_reflect_plan(cls._fields_reflected_on_error)
+
+    @classmethod
+    def _compile_field_plan(cls, fields):
+        fields = ObjectProcessor._get_strlist_or_default(fields, None)
+        if fields is None:
+            return None
+        return tuple((field, field + ERROR_FIELD_SUFFIX, cls._get_validation_func(field)) for field in fields)
+
+    @staticmethod
+    def _compile_reflect_plan(fields_reflected_on_error):
+        fields = ObjectProcessor._get_strlist_or_default(fields_reflected_on_error, ())
+        return tuple((field, field + ERROR_FIELD_SUFFIX) for field in fields)
+
     def _process_object(self, obj):
         # Subclasses should override this to take an object in the form of a dict
         # with parsed field values and process it (creating database entries, etc.)
@@ -101,6 +220,25 @@ class ObjectProcessor(object):
         # not fit well with any one field (e.g. those depending on context, etc.)
         pass
 
+    def _prefetch(self, targets):
+        # Subclasses can override this to load, with as few queries as possible, any database
+        # state their validation methods need for all of the given targets, returning it in
+        # any form. While process_batch() runs, the returned value is available as
+        # self._prefetched and validation methods should consult it instead of the database.
+        return None
+
+    def _update_prefetched(self, obj):
+        # Subclasses can override this to record a validated object of a batch in
+        # self._prefetched, so that the targets after it are validated as if it already
+        # were in the database (e.g. to detect duplicates within the batch)
+        pass
+
+    def _process_objects(self, objs, commit=True):
+        # Subclasses can override this to process all validated objects of a batch at once
+        # (e.g. with a single bulk insert). The default processes them one at a time.
+        for obj in objs:
+            self._process_object(obj)
+
     @staticmethod
     def _get_strlist_or_default(strlist, default):
         if strlist is None:
@@ -109,71 +247,109 @@ class ObjectProcessor(object):
             strlist = (strlist,)
         return strlist
 
+    @timed("process", per_class=True)
     def process(self, target, fields=None, fields_reflected_on_error=None, fail_fast_on_missing=False):
         # This method validates the given target and processes it if valid, or returns a error response if not
         # This method returns a tuple of the form (passed, response)
         #   where passed is a boolean that is True if all validation on this target passed (False otherwise)
         #   and where response contains the data payload (can be None if no changes wanted)
+        passed, response = self._validate(target, fields, fields_reflected_on_error, fail_fast_on_missing)
+        if not passed:
+            return False, response
+        else:
+            return True, self._process_object(target)
 
+    @timed("process_batch", per_class=True)
+    def process_batch(self, targets, fields=None, fields_reflected_on_error=None, fail_fast_on_missing=False,
+                      commit=True):
+        # This method validates each of the given targets like process() does, but loads the database
+        # state needed for validation up front and processes all valid targets together afterwards.
+        # If commit is False, the processed objects are left in the current transaction.
+        # This method returns a list of the error responses of the targets that failed validation, in order.
+        self._prefetched = self._prefetch(targets)
+        try:
+            errors = []
+            valid_objs = []
+            for target in targets:
+                passed, response = self._validate(target, fields, fields_reflected_on_error, fail_fast_on_missing)
+                if passed:
+                    valid_objs.append(target)
+                    self._update_prefetched(target)
+                else:
+                    errors.append(response)
+        finally:
+            self._prefetched = None
+
+        self._process_objects(valid_objs, commit)
+        return errors
+
+    def _validate(self, target, fields, fields_reflected_on_error, fail_fast_on_missing):
+        # This method returns a tuple of the form (passed, response)
+        #   where response is the error response if validation failed (None otherwise)
         if self._single_use and self._num_uses > 0:
             raise SingleUseViolation(self.__class__)
 
         if not isinstance(target, dict):
             return False, CODE_INCORRECT_TYPE
 
-        fields = ObjectProcessor._get_strlist_or_default(fields, self._fields)
-        if fields is None:
+        field_plan = self._field_plan if fields is None else self._compile_field_plan(fields)
+        if field_plan is None:
             raise ValidationFatal("No fields to validate")
 
-        fields_reflected_on_error = ObjectProcessor._get_strlist_or_default(fields_reflected_on_error,
-                                                                            self._fields_reflected_on_error)
         if fields_reflected_on_error is None:
-            fields_reflected_on_error = []
+            reflect_plan = self._reflect_plan
+        else:
+            reflect_plan = self._compile_reflect_plan(fields_reflected_on_error)
 
         self._num_uses += 1
 
-        try:
-            self._process_fields(fields, target, fail_fast_on_missing)
-        except UnsuccessfulProcessing as u:
-            return self._render(False, u.response, target, fields_reflected_on_error)
+        response = self._process_fields(field_plan, target, fail_fast_on_missing)
+        if response is not None:
+            return self._render(False, response, target, reflect_plan)
         else:
-            return True, self._process_object(target)
+            return True, None
 
-    def _process_fields(self, fields, target, fail_fast_on_missing):
+    def _process_fields(self, field_plan, target, fail_fast_on_missing):
+        # This method returns the error response if validation failed, None otherwise
         response = {}
 
-        for field in fields:
-            error_field = field + ERROR_FIELD_SUFFIX
+        for field, error_field, validation_func in field_plan:
+            if field not in target:
+                response[error_field] = CODE_MISSING
+                if fail_fast_on_missing:
+                    return response
+                continue
+
             try:
-                value = target[field]
-                validation_func = self._get_validation_func(field)
-                try:
-                    new_value = validation_func(value)
-                    if new_value is not None:
-                        target[field] = new_value
-                except ValidationError as ve:
-                    response[error_field] = int(ve)
-                    if ve.parallel_insert is not None:
-                        response.update(ve.parallel_insert)
-                    if isinstance(ve, ValidationFailFastError):
-                        raise UnsuccessfulProcessing(response)
+                new_value = validation_func(self, target[field])
+            except ValidationError as ve:
+                response[error_field] = int(ve)
+                if ve.parallel_insert is not None:
+                    response.update(ve.parallel_insert)
+                if isinstance(ve, ValidationFailFastError):
+                    return response
             except (ValueError, KeyError):
                 response[error_field] = CODE_MISSING
                 if fail_fast_on_missing:
-                    raise UnsuccessfulProcessing(response)
+                    return response
+            else:
+                if new_value is not None:
+                    target[field] = new_value
 
         if len(response) > 0:
-            raise UnsuccessfulProcessing(response)
+            return response
+        else:
+            return None
 
-    def _get_validation_func(self, field):
+    @classmethod
+    def _get_validation_func(cls, field):
         try:
-            return getattr(self, "_validate_" + field)
+            return getattr(cls, "_validate_" + field)
         except AttributeError:
             raise ValidationFatal("No validation method exists for field: {}".format(field))
 
-    def _render(self, passed, payload, target, reflect_fields):
-        for field in reflect_fields:
-            error_field = field + ERROR_FIELD_SUFFIX
+    def _render(self, passed, payload, target, reflect_plan):
+        for field, error_field in reflect_plan:
             if not (error_field in payload and payload[error_field] == CODE_MISSING):
                 payload[field] = target[field]
         return passed, payload
@@ -194,11 +370,16 @@ class NoteProcessor(ObjectProcessor):
     _fields = "note_id", "date_created"
     _fields_reflected_on_error = "note_id"
 
+    def _prefetch(self, targets):
+        return _query_owners(Note.note_id, Note.user_id, _collect_uuids(targets, "note_id"))
+
+    def _update_prefetched(self, obj):
+        self._prefetched[obj["note_id"]] = self.user_id
+
     def _validate_note_id(self, uuid):
         _validate_uuid(uuid)
-        try:
-            (existing_note_owner,) = db_session.query(Note.user_id).filter(Note.note_id == uuid).one()
-        except NoResultFound:
+        existing_note_owner = _get_owner(self._prefetched, Note.note_id, Note.user_id, uuid)
+        if existing_note_owner is None:
             # There is no conflict in the db, let validation pass
             pass
         else:
@@ -215,24 +396,47 @@ class NoteProcessor(ObjectProcessor):
         obj["user_id"] = self.user_id
         note = Note(**obj)
         db_session.add(note)
+        _record_changes(self.user_id, CHANGE_TYPE_NOTE, [obj["note_id"]])
         db_session.commit()
 
+    def _process_objects(self, objs, commit=True):
+        if len(objs) > 0:
+            db_session.execute(Note.__table__.insert(),
+                               [{"note_id": obj["note_id"],
+                                 "user_id": self.user_id,
+                                 "date_created": obj["date_created"]} for obj in objs])
+            _record_changes(self.user_id, CHANGE_TYPE_NOTE, [obj["note_id"] for obj in objs])
+        if commit:
+            db_session.commit()
+
 
 class NoteContentProcessor(ObjectProcessor):
     # This Processor must be instantiated with a context containing 'user_id'
     _fields = "note_content_id", "note", "type", "data", "date_created"
     _fields_reflected_on_error = "note_content_id"
 
+    # Context: maximum number of deltas stored on top of a full text, 0 to only store full texts
+    delta_depth = 0
+
+    def _prefetch(self, targets):
+        return {
+            "note_content_owners": _query_owners(NoteContent.note_content_id, NoteContent.user_id,
+                                                 _collect_uuids(targets, "note_content_id")),
+            "note_owners": _query_owners(Note.note_id, Note.user_id, _collect_uuids(targets, "note"))
+        }
+
+    def _update_prefetched(self, obj):
+        self._prefetched["note_content_owners"][obj["note_content_id"]] = self.user_id
+
     def _validate_note_content_id(self, uuid):
         _validate_uuid(uuid)
-        try:
-            (existing_nc_note_id,) = db_session.query(NoteContent.note_id).filter(NoteContent.note_content_id == uuid).one()
-        except NoResultFound:
+        prefetched_owners = self._prefetched["note_content_owners"] if self._prefetched is not None else None
+        existing_nc_owner = _get_owner(prefetched_owners, NoteContent.note_content_id, NoteContent.user_id, uuid)
+        if existing_nc_owner is None:
             # There is no conflict in the db, let validation pass
             pass
         else:
             # There is a conflict in the db
-            (existing_nc_owner,) = db_session.query(Note.user_id).filter(Note.note_id == existing_nc_note_id).one()
             if existing_nc_owner == self.user_id:
                 raise ValidationFailFastError(CODE_ALREADY_EXISTS_CONFLICT)
             else:
@@ -240,12 +444,10 @@ class NoteContentProcessor(ObjectProcessor):
 
     def _validate_note(self, note_id):
         _validate_uuid(note_id)
-        try:
-            note_id, user_id = db_session.query(Note.note_id, Note.user_id).filter(Note.note_id == note_id).one()
-        except NoResultFound:
+        prefetched_owners = self._prefetched["note_owners"] if self._prefetched is not None else None
+        user_id = _get_owner(prefetched_owners, Note.note_id, Note.user_id, note_id)
+        if user_id is None:
             raise ValidationFailFastError(CODE_DOES_NOT_EXIST)
-        except MultipleResultsFound:
-            raise ValidationFatal("Non-unique note_id detected in database.")
         else:
             if user_id == self.user_id:
                 self.note_id = note_id
@@ -264,16 +466,61 @@ class NoteContentProcessor(ObjectProcessor):
         _validate_date(date)
 
     def _process_object(self, obj):
+        full_text = obj["data"]
+        ((obj["data"], obj["data_base_id"], obj["data_depth"]),) = encode_revisions([obj], self.delta_depth)
         obj["note_id"] = obj["note"]
         del obj["note"]
+        obj["user_id"] = self.user_id
         note_content = NoteContent(**obj)
         db_session.add(note_content)
+        db_session.flush()
+        _update_current_note_contents(self.user_id, [(obj["note_id"], obj["date_created"], obj["note_content_id"])])
+        index_note_contents(self.user_id, [(obj["note_content_id"], full_text)])
+        _record_changes(self.user_id, CHANGE_TYPE_NOTE_CONTENT, [obj["note_content_id"]])
         db_session.commit()
 
+    def _process_objects(self, objs, commit=True):
+        if len(objs) > 0:
+            encoded = encode_revisions(objs, self.delta_depth)
+            db_session.execute(NoteContent.__table__.insert(),
+                               [{"note_content_id": obj["note_content_id"],
+                                 "note_id": obj["note"],
+                                 "user_id": self.user_id,
+                                 "type": obj["type"],
+                                 "data": data,
+                                 "data_base_id": data_base_id,
+                                 "data_depth": data_depth,
+                                 "date_created": obj["date_created"]}
+                                for obj, (data, data_base_id, data_depth) in zip(objs, encoded)])
+            _update_current_note_contents(self.user_id, [(obj["note"], obj["date_created"], obj["note_content_id"])
+                                                         for obj in objs])
+            index_note_contents(self.user_id, [(obj["note_content_id"], obj["data"]) for obj in objs])
+            _record_changes(self.user_id, CHANGE_TYPE_NOTE_CONTENT, [obj["note_content_id"] for obj in objs])
+        if commit:
+            db_session.commit()
+
 
 class AuthenticationProcessor(ObjectProcessor):
+    # The user looked up while validating is kept on the instance, so each authentication needs
+    # an instance of its own: requests served concurrently (by threads, or interleaved on an event
+    # loop by tuhi_flask.asgi) would otherwise authenticate as each other's users
     _fields = "username", "password"
-    # _single_use = True
+    _single_use = True
+
+    def process(self, target, *args, **kwargs):
+        # Credentials verified recently are answered from the cache without touching the
+        # database or re-hashing the password
+        if isinstance(target, dict):
+            user_id = credential_cache.get(target.get("username"), target.get("password"))
+            if user_id is not None:
+                return True, user_id
+
+        passed, result = super(AuthenticationProcessor, self).process(target, *args, **kwargs)
+        if not passed:
+            return False, result
+        # The user the password was verified against, as returned by _process_object()
+        credential_cache.put(result, target["password"])
+        return True, result.user_id
 
     def _validate_username(self, val):
         _validate_type(val, str)
@@ -292,4 +539,4 @@ class AuthenticationProcessor(ObjectProcessor):
             raise ValidationFailFastError(CODE_PASSWORD_INCORRECT)
 
     def _process_object(self, obj):
-        return self.user_to_auth.user_id
+        return self.user_to_auth
@@ -0,0 +1,216 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import hashlib
+import math
+import os
+import struct
+import time
+from threading import Lock
+from tuhi_flask.cache import LRUCache
+
+# Budgets, each a token bucket per key: failed authentications per client address, GET requests
+# per user and note plus note content items uploaded per user
+BUDGET_AUTH_FAILURES = "auth_failures"
+BUDGET_GETS = "gets"
+BUDGET_POST_ITEMS = "post_items"
+
+# Files are pruned once every this many takes from a FileRateLimitStore
+FILE_STORE_PRUNE_INTERVAL = 10000
+
+
+def _refill(state, burst, rate, now):
+    # Returns the tokens in a bucket last left with state (tokens, time), or None for a full bucket
+    if state is None:
+        return burst
+    tokens, updated = state
+    return min(burst, tokens + (now - updated) * rate)
+
+def _take(tokens, cost, burst, rate):
+    # Returns a tuple of the form (tokens left, seconds to wait or 0 if cost was taken). Costs
+    # above burst only need a full bucket, leaving it in debt, so that they are still admitted.
+    needed = min(cost, burst)
+    if tokens < needed:
+        return tokens, (needed - tokens) / rate
+    return tokens - cost, 0
+
+
+class MemoryRateLimitStore(object):
+    # Keeps the buckets of up to max_size keys in this process's memory. Evicted keys start
+    # over with a full bucket.
+
+    def __init__(self, max_size):
+        self._buckets = LRUCache(max_size)
+        self._lock = Lock()
+
+    def take(self, key, cost, burst, rate, now):
+        with self._lock:
+            tokens, wait = _take(_refill(self._buckets.get(key), burst, rate, now), cost, burst, rate)
+            if wait == 0:
+                self._buckets.put(key, (tokens, now))
+        return wait
+
+    def peek(self, key, burst, rate, now):
+        with self._lock:
+            return _refill(self._buckets.get(key), burst, rate, now)
+
+
+class FileRateLimitStore(object):
+    # Keeps each bucket in a small file under directory, updated under an exclusive lock, so
+    # that all worker processes on the machine share the same budgets. A tmpfs directory such
+    # as /dev/shm keeps them in shared memory. Each file also records when its bucket will have
+    # refilled completely, after which it holds nothing a missing file would not, so that any
+    # process can delete it regardless of the budget it belongs to.
+
+    # (tokens, time they were counted, time the bucket is full again)
+    _format = struct.Struct("ddd")
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._takes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _read(self, f):
+        # Returns the (tokens, time) state stored in f, None if there is none, and the time the
+        # bucket is full again
+        data = f.read(self._format.size)
+        if len(data) != self._format.size:
+            return None, 0
+        tokens, updated, full = self._format.unpack(data)
+        return (tokens, updated), full
+
+    def take(self, key, cost, burst, rate, now):
+        with open(self._path(key), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            state, full = self._read(f)
+            tokens, wait = _take(_refill(state, burst, rate, now), cost, burst, rate)
+            if wait == 0:
+                f.seek(0)
+                f.truncate()
+                f.write(self._format.pack(tokens, now, now + (burst - tokens) / rate))
+        self._takes += 1
+        if self._takes % FILE_STORE_PRUNE_INTERVAL == 0:
+            self.prune(now)
+        return wait
+
+    def peek(self, key, burst, rate, now):
+        try:
+            with open(self._path(key), "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                state, full = self._read(f)
+                return _refill(state, burst, rate, now)
+        except FileNotFoundError:
+            return burst
+
+    def prune(self, now):
+        for entry in os.scandir(self._directory):
+            try:
+                with open(entry.path, "rb") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    state, full = self._read(f)
+                    # A take waiting on the lock meanwhile updates the deleted file, so that
+                    # its bucket starts over full, which it was about to be anyway
+                    if full < now:
+                        os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class RateLimiter(object):
+    # Admission control. Each budget is configured as a (burst, rate) pair: a bucket holding
+    # up to burst tokens, refilled at rate tokens per second, from which each request takes
+    # its cost. Requests finding too few tokens are rejected, and told how long to wait.
+
+    def __init__(self, store=None, budgets=None):
+        self._lock = Lock()
+        self.configure(store, budgets or {})
+
+    def configure(self, store, budgets):
+        self._store = store
+        self._budgets = budgets
+        with self._lock:
+            self._counts = {}
+
+    @property
+    def enabled(self):
+        return self._store is not None
+
+    def _count(self, budget, outcome):
+        with self._lock:
+            self._counts[budget, outcome] = self._counts.get((budget, outcome), 0) + 1
+
+    def take(self, budget, key, cost=1):
+        # Takes cost tokens from the key's bucket of the given budget. Returns the number of
+        # seconds to wait before retrying if there are too few, None if the request is admitted.
+        if not self.enabled or self._budgets.get(budget) is None:
+            return None
+        wait = self.charge(budget, key, cost)
+        self._count(budget, "admitted" if wait is None else "limited")
+        return wait
+
+    def charge(self, budget, key, cost=1):
+        # Like take(), but for budgets charged once a request's outcome is known (failed
+        # authentications), which are not counted as admissions
+        if not self.enabled or self._budgets.get(budget) is None:
+            return None
+        burst, rate = self._budgets[budget]
+        wait = self._store.take("{}:{}".format(budget, key), cost, burst, rate, time.time())
+        return wait if wait > 0 else None
+
+    def check(self, budget, key):
+        # Returns the seconds to wait if the key's bucket of the given budget is empty, None
+        # otherwise, without taking anything
+        if not self.enabled or self._budgets.get(budget) is None:
+            return None
+        burst, rate = self._budgets[budget]
+        tokens = self._store.peek("{}:{}".format(budget, key), burst, rate, time.time())
+        if tokens >= 1:
+            return None
+        self._count(budget, "limited")
+        return (1 - tokens) / rate
+
+    def stats(self):
+        # Counters are kept per process
+        with self._lock:
+            return dict(self._counts)
+
+
+def retry_after(wait):
+    # Value of the Retry-After header for a wait given in seconds
+    return str(max(1, math.ceil(wait)))
+
+
+rate_limiter = RateLimiter()
+
+def init_rate_limiter(config):
+    backend = config['RATE_LIMIT_BACKEND']
+    budgets = {BUDGET_AUTH_FAILURES: config['RATE_LIMIT_AUTH_FAILURES'],
+               BUDGET_GETS: config['RATE_LIMIT_GETS'],
+               BUDGET_POST_ITEMS: config['RATE_LIMIT_POST_ITEMS']}
+    if backend is None:
+        rate_limiter.configure(None, budgets)
+    elif backend == 'memory':
+        rate_limiter.configure(MemoryRateLimitStore(config['RATE_LIMIT_SIZE']), budgets)
+    elif backend == 'file':
+        rate_limiter.configure(FileRateLimitStore(config['RATE_LIMIT_DIR']), budgets)
+    else:
+        raise ValueError("Unknown RATE_LIMIT_BACKEND: {}".format(backend))
@@ -27,6 +27,12 @@ CODE_TOO_LONG = 21
 CODE_INVALID_DATE = 23
 CODE_INVALID_UUID = 31
 
+CODE_USER_MOVED = 51
+CODE_RATE_LIMITED = 52
+
 CODE_FORBIDDEN = 90
 CODE_PASSWORD_INCORRECT = 92
 CODE_BAD_BASIC_AUTH_FORMAT = 94
+CODE_TOKEN_INVALID = 96
+CODE_TOKEN_EXPIRED = 97
+CODE_TOKEN_REVOKED = 98
@@ -0,0 +1,152 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from difflib import SequenceMatcher
+from tuhi_flask.database import db_session, IN_CLAUSE_CHUNK_SIZE
+from tuhi_flask.models import NoteContent, CurrentNoteContent
+
+# Note contents may store their data as a delta against the full text of another revision of the
+# same note (NoteContent.data_base_id), instead of as full text. A delta is a JSON array whose
+# items are either [start, end], copying lines start to end of the base text, or a string to be
+# inserted as is. NoteContent.data_depth counts the deltas to apply from the last full snapshot.
+
+
+def make_delta(base_text, text):
+    base_lines = base_text.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    delta = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, base_lines, lines, autojunk=False).get_opcodes():
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append("".join(lines[j1:j2]))
+    return json.dumps(delta, separators=(",", ":"))
+
+def apply_delta(base_text, delta):
+    base_lines = base_text.splitlines(keepends=True)
+    return "".join(item if isinstance(item, str) else "".join(base_lines[item[0]:item[1]])
+                   for item in json.loads(delta))
+
+
+def _load_stored(ids):
+    # Returns a dict mapping each of the given note content ids to its (data, data_base_id)
+    ids = list(ids)
+    stored = {}
+    for i in range(0, len(ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = ids[i:i + IN_CLAUSE_CHUNK_SIZE]
+        for note_content_id, data, data_base_id in db_session.query(
+                NoteContent.note_content_id, NoteContent.data, NoteContent.data_base_id) \
+                .filter(NoteContent.note_content_id.in_(chunk)):
+            stored[note_content_id] = (data, data_base_id)
+    return stored
+
+def resolve_texts(stored):
+    # Takes a dict mapping note content ids to their stored (data, data_base_id) and returns a
+    # dict mapping the same ids to their full text, loading any further revisions needed
+    stored = dict(stored)
+    missing = set(base_id for (data, base_id) in stored.values() if base_id is not None) - set(stored)
+    while len(missing) > 0:
+        loaded = _load_stored(missing)
+        stored.update(loaded)
+        missing = set(base_id for (data, base_id) in loaded.values() if base_id is not None) - set(stored)
+
+    texts = {}
+    for note_content_id in stored:
+        # Walk down to the nearest revision whose text is known, then apply deltas back up
+        chain = []
+        current = note_content_id
+        while current not in texts:
+            data, base_id = stored[current]
+            if base_id is None:
+                texts[current] = data
+                break
+            chain.append(current)
+            current = base_id
+        for delta_id in reversed(chain):
+            data, base_id = stored[delta_id]
+            texts[delta_id] = apply_delta(texts[base_id], data)
+    return texts
+
+def expand_rows(rows, id_index, data_index, chunk_size=500):
+    # Takes rows (tuples) of note content columns that include the note content id at id_index
+    # and the stored data at data_index, followed by a final extra column holding
+    # NoteContent.data_base_id. Yields the same rows without the extra column and with their
+    # data replaced by full text. Rows are handled chunk_size at a time, so that rows can be
+    # streamed from the database.
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield from _expand_chunk(chunk, id_index, data_index)
+            chunk = []
+    if len(chunk) > 0:
+        yield from _expand_chunk(chunk, id_index, data_index)
+
+def _expand_chunk(rows, id_index, data_index):
+    if all(row[-1] is None for row in rows):
+        for row in rows:
+            yield tuple(row[:-1])
+        return
+
+    texts = resolve_texts({row[id_index]: (row[data_index], row[-1]) for row in rows})
+    for row in rows:
+        expanded = list(row[:-1])
+        expanded[data_index] = texts[row[id_index]]
+        yield tuple(expanded)
+
+
+def encode_revisions(objs, max_depth):
+    # Takes validated note content objects (dicts with "note_content_id", "note" and "data"),
+    # in order of insertion, and returns a list holding the (data, data_base_id, data_depth) to
+    # store for each. Each revision is stored as a delta against the latest revision of its note
+    # unless that would put more than max_depth deltas on top of the last full snapshot, or the
+    # delta is not smaller than the full text.
+    if max_depth <= 0:
+        return [(obj["data"], None, 0) for obj in objs]
+
+    latest = _load_latest_revisions(set(obj["note"] for obj in objs))
+    encoded = []
+    for obj in objs:
+        text = obj["data"]
+        stored = (text, None, 0)
+        if obj["note"] in latest:
+            base_id, base_text, base_depth = latest[obj["note"]]
+            if base_depth < max_depth:
+                delta = make_delta(base_text, text)
+                if len(delta) < len(text):
+                    stored = (delta, base_id, base_depth + 1)
+        encoded.append(stored)
+        latest[obj["note"]] = (obj["note_content_id"], text, stored[2])
+    return encoded
+
+def _load_latest_revisions(note_ids):
+    # Returns a dict mapping each of the given notes that has contents to the
+    # (note_content_id, full text, data_depth) of its current revision
+    note_ids = list(note_ids)
+    rows = []
+    for i in range(0, len(note_ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = note_ids[i:i + IN_CLAUSE_CHUNK_SIZE]
+        rows.extend(db_session.query(CurrentNoteContent.note_id, NoteContent.note_content_id, NoteContent.data,
+                                     NoteContent.data_base_id, NoteContent.data_depth)
+                    .join(NoteContent, NoteContent.note_content_id == CurrentNoteContent.note_content_id)
+                    .filter(CurrentNoteContent.note_id.in_(chunk)))
+
+    texts = resolve_texts({note_content_id: (data, data_base_id)
+                           for (note_id, note_content_id, data, data_base_id, depth) in rows})
+    return {note_id: (note_content_id, texts[note_content_id], depth)
+            for (note_id, note_content_id, data, data_base_id, depth) in rows}
@@ -0,0 +1,139 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import text, table, column, func, literal_column, bindparam
+from tuhi_flask import database
+from tuhi_flask.database import db_session
+from tuhi_flask.models import NoteContent, CurrentNoteContent
+from tuhi_flask.revisions import resolve_texts
+
+# Text search configuration used for PostgreSQL documents and queries. 'simple' only lower-cases
+# words, like SQLite's unicode61 tokenizer, so that results do not depend on the database.
+POSTGRES_SEARCH_CONFIG = 'simple'
+
+note_content_search = table("note_content_search", column("note_content_id"), column("data"),
+                            column("user_id"), column("document"))
+
+
+def insert_statement(dialect_name):
+    # Returns the statement indexing a note content, given its note_content_id, user_id and full text (data)
+    if dialect_name == 'sqlite':
+        return text("INSERT INTO note_content_search (data, user_id, note_content_id) "
+                    "VALUES (:data, :user_id, :note_content_id)")
+    elif dialect_name == 'postgresql':
+        return text("INSERT INTO note_content_search (note_content_id, document) "
+                    "VALUES (:note_content_id, to_tsvector('{}', :data))".format(POSTGRES_SEARCH_CONFIG))
+    else:
+        raise ValueError("Full-text search is not supported on {}".format(dialect_name))
+
+def index_note_contents(user_id, texts):
+    # Adds (note_content_id, full text) pairs of the user's new note contents to the index
+    if database.search_enabled and len(texts) > 0:
+        db_session.execute(insert_statement(db_session.get_bind().dialect.name),
+                           [{"note_content_id": note_content_id, "user_id": user_id, "data": data}
+                            for note_content_id, data in texts])
+
+
+def unindex_note_contents(user_id, note_content_ids):
+    # Removes the given note contents of the user from the index
+    if not database.search_enabled or len(note_content_ids) == 0:
+        return
+    dialect_name = db_session.get_bind().dialect.name
+    if dialect_name == 'sqlite':
+        # Matching on user_id first spares scanning the whole table for the unindexed note_content_id
+        statement = text("DELETE FROM note_content_search WHERE rowid IN (SELECT rowid FROM note_content_search "
+                         "WHERE note_content_search MATCH :match AND note_content_id IN :ids)") \
+            .bindparams(match='user_id : "{}"'.format(user_id))
+    elif dialect_name == 'postgresql':
+        statement = text("DELETE FROM note_content_search WHERE note_content_id IN :ids")
+    else:
+        raise ValueError("Full-text search is not supported on {}".format(dialect_name))
+    db_session.execute(statement.bindparams(bindparam("ids", value=list(note_content_ids), expanding=True)))
+
+
+def index_note_rows(connection, rows):
+    # Indexes note contents given as (note_content_id, note_id, user_id, data, data_base_id) rows
+    # on connection. Deltas are only ever based on revisions of the same note, so when all of a
+    # note's revisions are given, none need be loaded to expand them.
+    if not database.search_enabled:
+        return
+    texts = resolve_texts({note_content_id: (data, data_base_id)
+                           for (note_content_id, note_id, user_id, data, data_base_id) in rows})
+    connection.execute(insert_statement(connection.dialect.name),
+                       [{"note_content_id": note_content_id, "user_id": user_id, "data": texts[note_content_id]}
+                        for (note_content_id, note_id, user_id, data, data_base_id) in rows])
+
+def unindex_user(connection, user_id, batch_size):
+    # Removes up to batch_size of the user's note contents from the index on connection,
+    # returning the number removed
+    if not database.search_enabled:
+        return 0
+    if connection.dialect.name == 'sqlite':
+        statement = text("DELETE FROM note_content_search WHERE rowid IN (SELECT rowid FROM note_content_search "
+                         "WHERE note_content_search MATCH :match LIMIT :batch_size)") \
+            .bindparams(match='user_id : "{}"'.format(user_id))
+    elif connection.dialect.name == 'postgresql':
+        statement = text("DELETE FROM note_content_search WHERE note_content_id IN (SELECT s.note_content_id "
+                         "FROM note_content_search s JOIN note_contents nc ON nc.note_content_id = s.note_content_id "
+                         "WHERE nc.user_id = :user_id LIMIT :batch_size)").bindparams(user_id=user_id)
+    else:
+        raise ValueError("Full-text search is not supported on {}".format(connection.dialect.name))
+    return connection.execute(statement.bindparams(batch_size=batch_size)).rowcount
+
+
+def parse_query(query):
+    # Splits a search query into a list of (word, is_prefix) pairs, all of which must match.
+    # Words ending with * match any word they are a prefix of. Anything else is matched literally.
+    words = []
+    for word in query.split():
+        is_prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if any(c.isalnum() for c in word):
+            words.append((word, is_prefix))
+    return words
+
+def _fts5_query(user_id, words):
+    terms = ['user_id : "{}"'.format(user_id)]
+    for word, is_prefix in words:
+        terms.append('data : "{}"{}'.format(word.replace('"', '""'), " *" if is_prefix else ""))
+    return " AND ".join(terms)
+
+def _tsquery(words):
+    return " & ".join("'{}'{}".format(word.replace("\\", "\\\\").replace("'", "''"), ":*" if is_prefix else "")
+                      for word, is_prefix in words)
+
+def search_note_contents(user_id, words, latest=False):
+    # Returns a query of the user's note contents matching all of the given words (see parse_query),
+    # most relevant first, optionally restricted to the current note content of each note
+    query = NoteContent.query.join(note_content_search,
+                                   note_content_search.c.note_content_id == NoteContent.note_content_id) \
+        .filter(NoteContent.user_id == user_id)
+    if latest:
+        query = query.join(CurrentNoteContent, CurrentNoteContent.note_content_id == NoteContent.note_content_id)
+
+    dialect_name = db_session.get_bind().dialect.name
+    if dialect_name == 'sqlite':
+        # The user_id column is given no weight in the ranking, as every match has the same
+        query = query.filter(literal_column("note_content_search").op("MATCH")(_fts5_query(user_id, words))) \
+            .order_by(func.bm25(literal_column("note_content_search"), 1.0, 0.0))
+    elif dialect_name == 'postgresql':
+        tsquery = func.to_tsquery(POSTGRES_SEARCH_CONFIG, _tsquery(words))
+        query = query.filter(note_content_search.c.document.op("@@")(tsquery)) \
+            .order_by(func.ts_rank(note_content_search.c.document, tsquery).desc())
+    else:
+        raise ValueError("Full-text search is not supported on {}".format(dialect_name))
+    return query.order_by(NoteContent.note_content_id)
@@ -28,25 +28,57 @@ class Serializer(object):
     # serialized field names here
     _field_mappings = {}
 
+    # Computed once for each subclass when it is defined from the attributes above: a tuple of
+    # (field, serialized field name, serialization function) with the function being None for
+    # fields that are serialized as is
+    _plan = ()
+    _serialized_names = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super(Serializer, cls).__init_subclass__(**kwargs)
+        if cls._default_serializer is Serializer._default_serializer:
+            default_func = None
+        else:
+            default_func = cls._default_serializer
+
+        plan = []
+        for field in cls._fields or ():
+            serialization_func = getattr(cls, "_serialize_" + field, default_func)
+            plan.append((field, cls._field_mappings.get(field, field), serialization_func))
+        cls._plan = tuple(plan)
+        cls._serialized_names = tuple(target for (field, target, serialization_func) in plan)
+
     def _default_serializer(self, val):
         return val
 
     def serialize(self, model_object):
         response = {}
-        for field in self._fields:
-            try:
-                serialization_func = getattr(self, "_serialize_" + field)
-            except AttributeError:
-                serialization_func = self._default_serializer
-
-            if field in self._field_mappings:
-                target = self._field_mappings[field]
+        for field, target, serialization_func in self._plan:
+            value = getattr(model_object, field)
+            if serialization_func is None:
+                response[target] = value
             else:
-                target = field
-
-            response[target] = serialization_func(getattr(model_object, field))
+                response[target] = serialization_func(self, value)
         return response
 
+    def columns(self, model):
+        # Returns the columns of the given model that serialize_many() expects its rows to hold
+        return [getattr(model, field) for field in self._fields]
+
+    def serialize_many(self, rows):
+        # Serializes tuples of field values ordered as returned by columns(), such as the rows of
+        # query.with_entities(*serializer.columns(Model)), without loading any model objects.
+        # This method is a generator yielding one serialized dict per row.
+        names = self._serialized_names
+        if all(serialization_func is None for (field, target, serialization_func) in self._plan):
+            for row in rows:
+                yield dict(zip(names, row))
+        else:
+            funcs = tuple(serialization_func for (field, target, serialization_func) in self._plan)
+            for row in rows:
+                yield {name: value if func is None else func(self, value)
+                       for name, func, value in zip(names, funcs, row)}
+
 
 class NoteSerializer(Serializer):
     _fields = "note_id", "date_created"
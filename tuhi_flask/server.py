@@ -0,0 +1,93 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+# Production server, running the app in gunicorn's pre-forked worker processes (optionally each
+# with a pool of threads). Requires gunicorn, installed with the 'server' extra. Sending the master
+# process SIGHUP gracefully replaces the workers, which (unless SERVER_PRELOAD is set) reload the
+# code and the app's configuration; SIGTERM lets in-flight requests finish before stopping.
+# With SERVER_ASYNC (or --async), workers instead serve tuhi_flask.asgi from uvicorn's event loop,
+# which needs the 'async' extra.
+
+import argparse
+import os
+from flask import Config
+from gunicorn.app.base import BaseApplication
+from tuhi_flask import database
+
+ASYNC_WORKER_CLASS = 'uvicorn.workers.UvicornWorker'
+
+
+def _load_config():
+    # The configuration tuhi_flask.app will use, read without importing (and so creating) the app
+    config = Config(os.path.dirname(os.path.abspath(__file__)))
+    config.from_object('tuhi_flask.default_config')
+    if os.getenv('TUHI_FLASK_CONFIG') is not None:
+        config.from_envvar('TUHI_FLASK_CONFIG')
+    return config
+
+def _post_fork(server, worker):
+    # With SERVER_PRELOAD, the app and its engines are created in the master. Their pooled
+    # connections (if any) must be neither used nor closed by the workers, which instead open
+    # their own once they first need one. Without it, the app is only created in the workers.
+    del server, worker
+    for engine in database.all_engines():
+        engine.dispose(close=False)
+
+
+class ServerApplication(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super(ServerApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        if self.options['worker_class'] == ASYNC_WORKER_CLASS:
+            from tuhi_flask.asgi import application
+            return application
+        from tuhi_flask.app import app
+        return app
+
+
+def main(argv=None):
+    config = _load_config()
+    parser = argparse.ArgumentParser(description="Serves tuhi-flask with multiple worker processes")
+    parser.add_argument("--bind", default=config['SERVER_BIND'], help="address (host:port or unix:path)")
+    parser.add_argument("--workers", type=int, default=config['SERVER_WORKERS'] or os.cpu_count())
+    parser.add_argument("--threads", type=int, default=config['SERVER_THREADS'], help="threads per worker")
+    parser.add_argument("--async", dest="use_async", action="store_true", default=config['SERVER_ASYNC'],
+                        help="serve the ASGI variant of the app from an event loop in each worker")
+    args = parser.parse_args(argv)
+
+    ServerApplication({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': ASYNC_WORKER_CLASS if args.use_async else 'sync',
+        'timeout': config['SERVER_TIMEOUT'],
+        'graceful_timeout': config['SERVER_GRACEFUL_TIMEOUT'],
+        'max_requests': config['SERVER_MAX_REQUESTS'],
+        'max_requests_jitter': config['SERVER_MAX_REQUESTS'] // 10,
+        'preload_app': config['SERVER_PRELOAD'],
+        'post_fork': _post_fork,
+        'proc_name': 'tuhi-flask',
+    }).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-user sharding. With DATABASE_SHARDS set, each user's notes, note contents and change log
+# live in a single database: the default one (DATABASE_URL) or one of the named shards. The
+# default database holds the users row of every user and acts as the directory: users.shard names
+# the shard holding the user's data, or is NULL if it is in the default database itself. Shards
+# hold a copy of the users row of the users they hold data for, with shard NULL.
+#
+# Users are moved between databases online by tuhi-flask-rebalance. The user's data is copied to
+# the target in small transactions while the user keeps using the source, then the source's users
+# row is locked while the changes made meanwhile are copied, after which the directory points at
+# the target and the source's row is set to the target's name. That row then fences off the
+# source: uploads that were waiting on the lock (or routed there just before the move) fail with
+# UserMoved instead of being lost, and are answered with 503 so that clients retry. The source's
+# copy is only deleted after a grace period, so that reads still in progress there are not cut short.
+
+import argparse
+import time
+from sqlalchemy import select, func, and_
+from tuhi_flask import database
+from tuhi_flask.database import db_session, current_shard
+from tuhi_flask.models import User, Note, NoteContent, CurrentNoteContent, Change, CHANGE_TYPE_NOTE
+from tuhi_flask.revisions import resolve_texts
+from tuhi_flask.search import insert_statement, unindex_user
+
+# Name under which DATABASE_URL is referred to by tuhi-flask-rebalance and in users.shard
+DEFAULT_SHARD = 'default'
+
+
+class UserMoved(Exception):
+    # Raised when writing the data of a user that has been moved to another database
+    pass
+
+
+def use_user_shard(user_id):
+    # Routes db_session's statements for the rest of the request to the database holding the
+    # user's data
+    current_shard.set(None)
+    if len(database.shard_engines) > 0:
+        shard = db_session.query(User.shard).filter(User.user_id == user_id).scalar()
+        if shard is not None and shard != DEFAULT_SHARD:
+            current_shard.set(shard)
+
+
+def _engine(name):
+    if name == DEFAULT_SHARD:
+        return database.engine
+    return database.shard_engines[name]
+
+def _batches(connection, query, key, batch_size):
+    # Yields the rows of query batch_size at a time, in order of key, a column that must be
+    # unique among them
+    last = None
+    while True:
+        batch_query = query.order_by(key)
+        if last is not None:
+            batch_query = batch_query.where(key > last)
+        rows = connection.execute(batch_query.limit(batch_size)).fetchall()
+        if len(rows) == 0:
+            return
+        yield rows
+        last = rows[-1]._mapping[key]
+
+def _copy_rows(connection, table, rows):
+    if len(rows) > 0:
+        connection.execute(table.insert(), [dict(row._mapping) for row in rows])
+
+
+def _copy_notes(source, target, user_id, note_ids):
+    # Copies the given notes, all their revisions not yet on target, their current revision and
+    # the search index entries of the copied revisions from source to target
+    notes = Note.__table__
+    note_contents = NoteContent.__table__
+    current = CurrentNoteContent.__table__
+    note_ids = list(note_ids)
+    present = set(target.execute(select(notes.c.note_id).where(notes.c.note_id.in_(note_ids))).scalars())
+    _copy_rows(target, notes, source.execute(select(notes).where(and_(notes.c.note_id.in_(note_ids),
+                                                                      notes.c.note_id.notin_(present)))).fetchall())
+
+    rows = source.execute(select(note_contents).where(note_contents.c.note_id.in_(note_ids))).fetchall()
+    present = set(target.execute(select(note_contents.c.note_content_id)
+                                 .where(note_contents.c.note_id.in_(note_ids))).scalars())
+    missing = [row for row in rows if row.note_content_id not in present]
+    # Bases are inserted before the deltas stored against them
+    _copy_rows(target, note_contents, sorted(missing, key=lambda row: row.data_depth))
+
+    target.execute(current.delete().where(current.c.note_id.in_(note_ids)))
+    _copy_rows(target, current, source.execute(select(current).where(current.c.note_id.in_(note_ids))).fetchall())
+
+    if database.search_enabled and len(missing) > 0:
+        # All revisions of the notes are at hand, so that deltas are expanded without loading any
+        texts = resolve_texts({row.note_content_id: (row.data, row.data_base_id) for row in rows})
+        target.execute(insert_statement(target.dialect.name),
+                       [{"note_content_id": row.note_content_id, "user_id": user_id,
+                         "data": texts[row.note_content_id]} for row in missing])
+
+
+def purge_user(connection, user_id, batch_size):
+    # Deletes the user's data, but not their users row, from the database of connection in
+    # transactions of up to batch_size rows each. Returns the number of rows deleted.
+    deleted = 0
+    while True:
+        with connection.begin():
+            count = unindex_user(connection, user_id, batch_size)
+        deleted += count
+        if count == 0:
+            break
+
+    changes = Change.__table__
+    current = CurrentNoteContent.__table__
+    note_contents = NoteContent.__table__
+    notes = Note.__table__
+    # Deltas are deleted before the revisions they are based on, which have a lower data_depth
+    for table, key, order in ((changes, changes.c.seq, changes.c.seq),
+                              (current, current.c.note_id, current.c.note_id),
+                              (note_contents, note_contents.c.note_content_id, note_contents.c.data_depth.desc()),
+                              (notes, notes.c.note_id, notes.c.note_id)):
+        while True:
+            with connection.begin():
+                keys = connection.execute(select(key).where(table.c.user_id == user_id)
+                                          .order_by(order).limit(batch_size)).scalars().all()
+                if len(keys) > 0:
+                    connection.execute(table.delete().where(and_(table.c.user_id == user_id, key.in_(keys))))
+            deleted += len(keys)
+            if len(keys) == 0:
+                break
+    return deleted
+
+
+def move_user(user_id, source_name, target_name, grace, batch_size, log=print):
+    users = User.__table__
+    notes = Note.__table__
+    changes = Change.__table__
+    with _engine(source_name).connect() as source, _engine(target_name).connect() as target:
+        user = source.execute(select(users).where(users.c.user_id == user_id)).one()
+        if user.shard is not None:
+            raise ValueError("User {} has no data in {}".format(user_id, source_name))
+        existing = target.execute(select(users.c.shard).where(users.c.user_id == user_id)).one_or_none()
+        if existing is not None and existing.shard is None:
+            raise ValueError("User {} already has data in {}".format(user_id, target_name))
+
+        # Leftovers of an earlier, interrupted move are cleared first
+        purge_user(target, user_id, batch_size)
+        with target.begin():
+            # Until the move completes, the target's row keeps uploads from being made to it
+            if existing is None:
+                target.execute(users.insert().values(dict(user._mapping, shard=source_name)))
+            else:
+                target.execute(users.update().where(users.c.user_id == user_id).values(shard=source_name))
+
+        # 1. Bulk of the data, copied while the user keeps using the source
+        (seq,) = source.execute(select(users.c.change_seq).where(users.c.user_id == user_id)).one()
+        copied = 0
+        for rows in _batches(source, select(notes.c.note_id).where(notes.c.user_id == user_id),
+                             notes.c.note_id, batch_size):
+            with target.begin():
+                _copy_notes(source, target, user_id, [note_id for (note_id,) in rows])
+            copied += len(rows)
+        for rows in _batches(source, select(changes).where(and_(changes.c.user_id == user_id, changes.c.seq <= seq)),
+                             changes.c.seq, batch_size):
+            with target.begin():
+                _copy_rows(target, changes, rows)
+        log("Copied {} notes and {} changes".format(copied, seq))
+
+        # 2. Changes made meanwhile, copied while the user's row in the source is locked
+        with source.begin():
+            locked = source.execute(users.update().where(and_(users.c.user_id == user_id, users.c.shard.is_(None)))
+                                    .values(change_seq=users.c.change_seq))
+            if locked.rowcount == 0:
+                raise ValueError("User {} was moved by another process".format(user_id))
+            (last_seq,) = source.execute(select(users.c.change_seq).where(users.c.user_id == user_id)).one()
+            new_changes = source.execute(select(changes).where(and_(changes.c.user_id == user_id,
+                                                                    changes.c.seq > seq))).fetchall()
+            with target.begin():
+                new_note_ids = set(row.object_id for row in new_changes if row.object_type == CHANGE_TYPE_NOTE)
+                new_note_ids |= set(source.execute(select(NoteContent.__table__.c.note_id).where(
+                    NoteContent.__table__.c.note_content_id.in_(
+                        [row.object_id for row in new_changes if row.object_type != CHANGE_TYPE_NOTE]))).scalars())
+                if len(new_note_ids) > 0:
+                    _copy_notes(source, target, user_id, new_note_ids)
+                _copy_rows(target, changes, new_changes)
+                target.execute(users.update().where(users.c.user_id == user_id)
+                               .values(shard=None, change_seq=last_seq))
+            if DEFAULT_SHARD not in (source_name, target_name):
+                with database.engine.begin() as directory:
+                    directory.execute(users.update().where(users.c.user_id == user_id).values(shard=target_name))
+            source.execute(users.update().where(users.c.user_id == user_id).values(shard=target_name))
+        log("Moved user {} to {} at change {}".format(user_id, target_name, last_seq))
+
+        # 3. The source's copy, once requests that were already reading it are done
+        time.sleep(grace)
+        log("Deleted {} rows from {}".format(purge_user(source, user_id, batch_size), source_name))
+
+
+def _print_stats():
+    users = User.__table__
+    with database.engine.connect() as connection:
+        counts = dict(connection.execute(select(func.coalesce(users.c.shard, DEFAULT_SHARD), func.count())
+                                         .group_by(users.c.shard)).fetchall())
+    for name in [DEFAULT_SHARD] + sorted(database.shard_engines):
+        print("{:<20} {:>10} users".format(name, counts.get(name, 0)))
+
+
+def main(argv=None):
+    from tuhi_flask.app import app
+    parser = argparse.ArgumentParser(description="Moves a user's data between databases (see DATABASE_SHARDS) "
+                                                 "while the server keeps running")
+    parser.add_argument("user", nargs="?", help="user id, or username with --username")
+    parser.add_argument("target", nargs="?", help="name of the shard to move the user to, or '{}' for "
+                                                  "DATABASE_URL".format(DEFAULT_SHARD))
+    parser.add_argument("--username", action="store_true", help="identify the user by username")
+    parser.add_argument("--grace", type=float, default=app.config['SHARD_MOVE_GRACE'],
+                        help="seconds to wait before deleting the user's data from the source")
+    parser.add_argument("--batch-size", type=int, default=app.config['SHARD_MOVE_BATCH_SIZE'])
+    args = parser.parse_args(argv)
+
+    if args.user is None:
+        _print_stats()
+        return
+    if args.target is None:
+        parser.error("the target shard is required")
+    if args.target != DEFAULT_SHARD and args.target not in database.shard_engines:
+        parser.error("unknown shard: {}".format(args.target))
+
+    users = User.__table__
+    user_column = users.c.username if args.username else users.c.user_id
+    with database.engine.connect() as directory:
+        user = directory.execute(select(users.c.user_id, users.c.shard).where(user_column == args.user)).one_or_none()
+    if user is None:
+        parser.error("no such user: {}".format(args.user))
+    source = DEFAULT_SHARD if user.shard is None else user.shard
+    if source == args.target:
+        parser.error("user {} is already in {}".format(args.user, source))
+    move_user(user.user_id, source, args.target, args.grace, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
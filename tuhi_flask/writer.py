@@ -0,0 +1,131 @@
+# Copyright 2015 icasdri
+#
+# This file is part of tuhi-flask.
+#
+# tuhi-flask is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tuhi-flask is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tuhi-flask.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import queue
+from threading import Event, Lock, Thread
+from tuhi_flask import database
+from tuhi_flask.database import db_session, run_blocking
+from tuhi_flask.metrics import timed
+
+
+class _WriteJob(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = Event()
+
+
+class GroupCommitWriter(object):
+    # Runs write jobs one after the other on a single thread with its own session. All jobs that
+    # queue up while a transaction is being committed are run in the next transaction, each in
+    # a savepoint of its own, so that one failing job does not undo the others.
+
+    def __init__(self, bind, max_batch):
+        self._bind = bind
+        self._max_batch = max_batch
+        self._queue = None
+        self._pid = None
+        self._lock = Lock()
+
+    def _ensure_started(self):
+        # The thread is started lazily, and again in processes forked after it started
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                Thread(target=self._run, name="tuhi-flask-writer", daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, func, *args):
+        # Runs func(*args) on the writer thread and returns its result once it has been
+        # committed, or raises the exception it raised
+        self._ensure_started()
+        job = _WriteJob(func, args)
+        self._queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _take_jobs(self):
+        jobs = [self._queue.get()]
+        while len(jobs) < self._max_batch:
+            try:
+                jobs.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run(self):
+        session = db_session(bind=self._bind)
+        while True:
+            jobs = self._take_jobs()
+            try:
+                for job in jobs:
+                    savepoint = session.begin_nested()
+                    try:
+                        job.result = job.func(*job.args)
+                    except Exception as e:
+                        savepoint.rollback()
+                        job.error = e
+                    else:
+                        savepoint.commit()
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                for job in jobs:
+                    if job.error is None:
+                        job.error = e
+            finally:
+                for job in jobs:
+                    job.done.set()
+
+
+writer = None
+# Writers of the shards that have a write engine, by name
+shard_writers = {}
+
+def init_writer(config):
+    global writer
+    if database.write_engine is not None:
+        writer = GroupCommitWriter(database.write_engine, config['SQLITE_GROUP_COMMIT_MAX_BATCH'])
+    else:
+        writer = None
+    shard_writers.clear()
+    for name, write_engine in database.shard_write_engines.items():
+        if write_engine is not None:
+            shard_writers[name] = GroupCommitWriter(write_engine, config['SQLITE_GROUP_COMMIT_MAX_BATCH'])
+
+@timed("write")
+def run_write(func, *args):
+    # Runs func(*args), which must not commit, and commits the changes it made to db_session,
+    # going through the writer thread of the current shard if there is one. Returns the result of func(*args).
+    shard = database.current_shard.get()
+    shard_writer = writer if shard is None else shard_writers.get(shard)
+    if shard_writer is not None:
+        return run_blocking(shard_writer.submit, func, *args)
+    try:
+        result = func(*args)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    return result